@@ -0,0 +1,115 @@
+"""
+Shared helpers for the FastAPI Prometheus Middleware examples.
+"""
+
+import asyncio
+import os
+from typing import Any, List, Optional
+
+from fastapi import FastAPI
+from fastapi_prometheus_middleware import PrometheusMiddleware, metrics_endpoint, generate_prometheus_data
+
+
+def get_metrics_path(filename: str = "app.prom") -> str:
+    """
+    Get the path of the file metrics are written to.
+
+    Uses $METRICS_DIR when set, otherwise /dev/shm when available so that
+    writes stay in memory, falling back to the current directory.
+
+    Args:
+        filename: Name of the metrics file (default: "app.prom")
+
+    Returns:
+        The path of the metrics file
+    """
+    directory = os.getenv("METRICS_DIR")
+    if not directory:
+        directory = "/dev/shm" if os.path.isdir("/dev/shm") else "."
+    return os.path.join(directory, filename)
+
+
+async def dump_loop(path: str, interval: int = 10):
+    """
+    Periodically write Prometheus metrics to a file.
+
+    Writes are scheduled against fixed deadlines, so the period does not drift
+    by the time each write takes.
+
+    Args:
+        path: Path to the file to write the metrics to
+        interval: Seconds between writes (default: 10)
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time()
+    while True:
+        await generate_prometheus_data(path)
+        deadline += interval
+        await asyncio.sleep(max(0, deadline - loop.time()))
+
+
+def start_metrics_dumper(app: FastAPI, path: str, interval: int = 10) -> None:
+    """
+    Start writing metrics to a file in the background.
+
+    Prometheus normally scrapes the /metrics endpoint, so the file dump is only
+    started when ENABLE_FILE_DUMP=1 is set. The task is kept on app.state so it
+    is not garbage collected and can be cancelled on shutdown.
+
+    Args:
+        app: The FastAPI application
+        path: Path to the file to write the metrics to
+        interval: Seconds between writes (default: 10)
+    """
+    if os.getenv("ENABLE_FILE_DUMP") != "1":
+        app.state.metrics_task = None
+        return
+
+    app.state.metrics_task = asyncio.create_task(dump_loop(path, interval))
+
+
+async def stop_metrics_dumper(app: FastAPI) -> None:
+    """
+    Stop the background metrics writer started by start_metrics_dumper.
+
+    Args:
+        app: The FastAPI application
+    """
+    task = getattr(app.state, "metrics_task", None)
+    if task is None:
+        return
+
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    app.state.metrics_task = None
+
+
+def attach_metrics(
+    app: FastAPI,
+    prefix: str = "fastapi",
+    skip_paths: Optional[List[str]] = None,
+    logger: Any = None
+) -> FastAPI:
+    """
+    Add the Prometheus middleware and the metrics endpoint to an app.
+
+    Args:
+        app: The FastAPI application
+        prefix: Prefix for Prometheus metrics (default: "fastapi")
+        skip_paths: List of paths to skip tracking (default: middleware defaults)
+        logger: Logger instance to use for logging (default: None)
+
+    Returns:
+        The same FastAPI application
+    """
+    app.add_middleware(
+        PrometheusMiddleware,
+        prefix=prefix,
+        skip_paths=skip_paths,
+        logger=logger
+    )
+    app.add_route('/metrics', metrics_endpoint)
+    return app
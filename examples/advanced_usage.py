@@ -7,14 +7,14 @@ import logging
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
 from fastapi_prometheus_middleware import (
-    PrometheusMiddleware, 
-    metrics_endpoint,
     track_detailed_exception,
     track_global_exception,
+    set_token_usage,
     wrap_streaming_response,
     streaming_response_decorator
 )
-from fastapi_prometheus_middleware.context import token_usage_context
+
+from _common import attach_metrics, get_metrics_path, start_metrics_dumper, stop_metrics_dumper
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -22,27 +22,22 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
-# Add the Prometheus middleware with custom configuration
-app.add_middleware(
-    PrometheusMiddleware,
+# Add the Prometheus middleware with custom configuration and the metrics endpoint
+attach_metrics(
+    app,
     prefix="advanced",  # Custom prefix for metrics
     skip_paths=["/metrics", "/health"],  # Paths to skip tracking
     logger=logger  # Custom logger
 )
 
-# Add the metrics endpoint
-app.add_route('/metrics', metrics_endpoint)
-
-# Write metrics to a file every 10 seconds
-async def write_metrics_to_file():
-    while True:
-        from fastapi_prometheus_middleware import generate_prometheus_data
-        await generate_prometheus_data("advanced_metrics.prom")
-        await asyncio.sleep(10)
-
+# Write metrics to a file every 10 seconds when ENABLE_FILE_DUMP=1 is set
 @app.on_event("startup")
 async def startup_event():
-    asyncio.create_task(write_metrics_to_file())
+    start_metrics_dumper(app, get_metrics_path("advanced_metrics.prom"))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await stop_metrics_dumper(app)
 
 @app.get("/")
 async def root():
@@ -55,11 +50,9 @@ async def generate_text(prompt: str):
     await asyncio.sleep(0.5)
     
     # Track token usage
-    token_data = token_usage_context.get()
-    token_data["input_tokens"] = len(prompt.split())  # Simple token count
-    token_data["output_tokens"] = 20  # Simulated output tokens
-    token_data["total_tokens"] = token_data["input_tokens"] + token_data["output_tokens"]
-    token_usage_context.set(token_data)
+    input_tokens = len(prompt.split())  # Simple token count
+    output_tokens = 20  # Simulated output tokens
+    set_token_usage(input_tokens, output_tokens)
     
     return {"text": f"Generated text based on: {prompt}"}
 
@@ -102,7 +95,8 @@ async def log_requests(request: Request, call_next):
     response = await call_next(request)
     
     # Log the request
-    logger.info(f"Request: {request.method} {request.url.path}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Request: %s %s", request.method, request.url.path)
     
     return response
 
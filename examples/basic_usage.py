@@ -2,32 +2,20 @@
 Basic usage example for FastAPI Prometheus Middleware.
 """
 
-import asyncio
 from fastapi import FastAPI
-from fastapi_prometheus_middleware import PrometheusMiddleware, metrics_endpoint, generate_prometheus_data
+
+from _common import attach_metrics
 
 app = FastAPI()
 
-# Add the Prometheus middleware
-app.add_middleware(
-    PrometheusMiddleware,
+# Add the Prometheus middleware and the metrics endpoint.
+# Point Prometheus at /metrics to scrape the metrics on demand.
+attach_metrics(
+    app,
     prefix="example",  # Custom prefix for metrics
     skip_paths=["/metrics", "/health"],  # Paths to skip tracking
 )
 
-# Add the metrics endpoint
-app.add_route('/metrics', metrics_endpoint)
-
-# Write metrics to a file every 10 seconds
-async def write_metrics_to_file():
-    while True:
-        await generate_prometheus_data("metrics.prom")
-        await asyncio.sleep(10)
-
-@app.on_event("startup")
-async def startup_event():
-    asyncio.create_task(write_metrics_to_file())
-
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
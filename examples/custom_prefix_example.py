@@ -9,25 +9,22 @@ import asyncio
 from fastapi import FastAPI
 from fastapi.responses import JSONResponse
 from fastapi_prometheus_middleware import (
-    PrometheusMiddleware,
-    metrics_endpoint,
     wrap_streaming_response,
     track_detailed_exception
 )
 from starlette.responses import StreamingResponse
 
+from _common import attach_metrics
+
 app = FastAPI()
 
-# Add the Prometheus middleware with a custom prefix
-app.add_middleware(
-    PrometheusMiddleware,
+# Add the Prometheus middleware with a custom prefix and the metrics endpoint
+attach_metrics(
+    app,
     prefix="custom_app",  # This prefix will be used for all metrics
     skip_paths=["/metrics", "/health"],
 )
 
-# Add the metrics endpoint
-app.add_route('/metrics', metrics_endpoint)
-
 # Regular endpoint
 @app.get("/hello")
 async def hello():
@@ -2,41 +2,27 @@
 Example showing how to use the fastapi-prometheus-middleware package in the Cerebrum project.
 """
 
-import asyncio
-import os
+import logging
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 
-# Import from the new package
-from fastapi_prometheus_middleware import PrometheusMiddleware, metrics_endpoint, generate_prometheus_data
+from _common import attach_metrics, get_metrics_path, start_metrics_dumper, stop_metrics_dumper
 
 # Constants
 PROMETHEUS_LOG_TIME = 10
 
-async def repeated_task_for_prometheus():
-    """
-    Periodically write Prometheus metrics to a file.
-    """
-    while True:
-        # Get the log file path from config
-        log_file = "logs.prom"
-        if os.getenv("METRICS_DIR"):
-            log_file = f'{os.getenv("METRICS_DIR")}/app.prom'
-
-        await generate_prometheus_data(log_file)
-        await asyncio.sleep(PROMETHEUS_LOG_TIME)
-
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
     FastAPI lifespan event handler.
     """
-    # Run startup tasks
-    asyncio.create_task(repeated_task_for_prometheus())
+    # Run startup tasks (metrics are written to a file when ENABLE_FILE_DUMP=1 is set)
+    start_metrics_dumper(app, get_metrics_path(), PROMETHEUS_LOG_TIME)
     yield
     # Run shutdown tasks
+    await stop_metrics_dumper(app)
 
 
 def get_app() -> FastAPI:
@@ -48,19 +34,10 @@ def get_app() -> FastAPI:
         lifespan=lifespan,
     )
 
-    # Add the Prometheus middleware with a custom prefix
-    import logging
+    # Add the Prometheus middleware with a custom prefix and the metrics endpoint
     logger = logging.getLogger(__name__)
-    
-    app.add_middleware(
-        PrometheusMiddleware,
-        prefix="myapp",
-        logger=logger
-    )
+    attach_metrics(app, prefix="myapp", logger=logger)
 
-    # Add the metrics endpoint
-    app.add_route('/metrics', metrics_endpoint)
-    
     return app
 
 
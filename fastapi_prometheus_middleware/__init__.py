@@ -28,5 +28,35 @@ from fastapi_prometheus_middleware.streaming_response import (
     create_metrics_streaming_response
 )
 from fastapi_prometheus_middleware.helper import generate_prometheus_data
+from fastapi_prometheus_middleware.context import (
+    token_usage_context,
+    TokenUsage,
+    set_token_usage,
+    reset_token_usage
+)
+
+__all__ = [
+    "PrometheusMiddleware",
+    "metrics_endpoint",
+    "APIMetrics",
+    "track_detailed_exception",
+    "track_global_exception",
+    "StreamingMetrics",
+    "register_metrics",
+    "get_metrics",
+    "get_all_metrics",
+    "StreamingMetricsWrapper",
+    "wrap_streaming_response",
+    "streaming_metrics_decorator",
+    "track_streaming_generator",
+    "create_streaming_response",
+    "streaming_response_decorator",
+    "create_metrics_streaming_response",
+    "generate_prometheus_data",
+    "token_usage_context",
+    "TokenUsage",
+    "set_token_usage",
+    "reset_token_usage",
+]
 
 __version__ = "0.1.0"
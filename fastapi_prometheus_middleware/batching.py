@@ -0,0 +1,110 @@
+"""
+Batching of metric updates made on hot paths.
+
+This module provides a batch that collects metric updates and applies them
+periodically on the event loop and whenever Prometheus collects metrics.
+"""
+
+import asyncio
+import logging
+import threading
+import weakref
+from collections import defaultdict
+from typing import Any, Callable, DefaultDict, Hashable, List, Optional
+
+from prometheus_client import REGISTRY
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Batches flushed on every collection of the default registry
+_batches: "weakref.WeakSet[MetricBatch]" = weakref.WeakSet()
+
+
+class MetricBatch:
+    """
+    Thread-safe batch of pending metric updates.
+
+    Values are grouped by key and handed to the apply callback when the batch
+    is flushed. A flush is scheduled on the running event loop after each
+    interval in which values were added, and every batch is also flushed when
+    the default registry is collected, so every exposition path sees all values.
+    """
+
+    def __init__(self, apply: Callable[[Any, List[Any]], None], interval: float):
+        """
+        Initialize the batch and flush it on every collection of the default registry.
+
+        Args:
+            apply: Callback invoked with each key and the list of values added for it
+            interval: Seconds between adding a value and the scheduled flush
+        """
+        self._apply = apply
+        self.interval = interval
+        self._pending: DefaultDict[Hashable, List[Any]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+        # Loop on which a flush is scheduled, or None if no flush is scheduled
+        self._flush_loop: Optional[asyncio.AbstractEventLoop] = None
+
+        _batches.add(self)
+
+    def add(self, key: Hashable, value: Any) -> None:
+        """
+        Add a value to the batch.
+
+        Outside of an event loop (e.g. in a sync endpoint running on a worker
+        thread) no flush is scheduled; the value is applied on the next flush.
+
+        Args:
+            key: Key the value is grouped under
+            value: The value to add
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        with self._lock:
+            self._pending[key].append(value)
+            # A flush scheduled on another loop may never run if that loop was closed
+            if loop is None or self._flush_loop is loop:
+                return
+            self._flush_loop = loop
+
+        loop.call_later(self.interval, self.flush)
+
+    def flush(self) -> None:
+        """
+        Apply all pending values.
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = defaultdict(list)
+            self._flush_loop = None
+
+        for key, values in pending.items():
+            self._apply(key, values)
+
+
+class _BatchFlushCollector:
+    """
+    Collector that flushes all batches when the default registry is collected.
+
+    It is registered when this module is imported, before any metric of this
+    package, so batched values are applied before those metrics are collected.
+    """
+
+    def describe(self) -> list:
+        return []
+
+    def collect(self) -> list:
+        for batch in list(_batches):
+            try:
+                batch.flush()
+            except Exception as e:
+                logger.warning(f"Error flushing metric batch: {e}")
+        return []
+
+
+REGISTRY.register(_BatchFlushCollector())
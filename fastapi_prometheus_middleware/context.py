@@ -2,10 +2,85 @@
 Context utilities for tracking token usage across async contexts.
 """
 
-from contextvars import ContextVar
+from collections import namedtuple
+from contextvars import ContextVar, Token
+from typing import List, Optional, Tuple
+
+# Immutable token usage record; set a new instance instead of mutating it
+TokenUsage = namedtuple("TokenUsage", ["input_tokens", "output_tokens", "total_tokens"])
+
+ZERO_TOKEN_USAGE = TokenUsage(0, 0, 0)
 
 # Context variable to track token usage
-token_usage_context: ContextVar[dict] = ContextVar(
+token_usage_context: ContextVar[TokenUsage] = ContextVar(
     "token_usage_context",
-    default={"total_tokens": 0, "input_tokens": 0, "output_tokens": 0}
+    default=ZERO_TOKEN_USAGE
 )
+
+# Per-request slot installed by the middleware. Endpoints may run in a copy of
+# the middleware's context (another task or a worker thread), so the usage is
+# also stored in this shared slot for the middleware to read back.
+_token_usage_slot: ContextVar[Optional[List[TokenUsage]]] = ContextVar(
+    "token_usage_slot",
+    default=None
+)
+
+
+def set_token_usage(input_tokens: int = 0, output_tokens: int = 0, total_tokens: Optional[int] = None) -> None:
+    """
+    Set the token usage for the current request.
+
+    Args:
+        input_tokens: Number of input tokens
+        output_tokens: Number of output tokens
+        total_tokens: Total number of tokens (default: input_tokens + output_tokens)
+    """
+    if total_tokens is None:
+        total_tokens = input_tokens + output_tokens
+    usage = TokenUsage(input_tokens, output_tokens, total_tokens)
+
+    token_usage_context.set(usage)
+    slot = _token_usage_slot.get()
+    if slot is not None:
+        slot[0] = usage
+
+
+def reset_token_usage() -> None:
+    """
+    Reset the token usage for the current context.
+    """
+    token_usage_context.set(ZERO_TOKEN_USAGE)
+
+
+def start_token_tracking() -> Tuple[Token, Token]:
+    """
+    Start tracking token usage for a request.
+
+    Returns:
+        Context tokens to pass to finish_token_tracking
+    """
+    return (
+        token_usage_context.set(ZERO_TOKEN_USAGE),
+        _token_usage_slot.set([ZERO_TOKEN_USAGE])
+    )
+
+
+def finish_token_tracking(tokens: Tuple[Token, Token]) -> TokenUsage:
+    """
+    Finish tracking token usage for a request and restore the previous context.
+
+    Args:
+        tokens: The context tokens returned by start_token_tracking
+
+    Returns:
+        The token usage recorded during the request
+    """
+    usage = token_usage_context.get()
+    slot = _token_usage_slot.get()
+    if slot is not None and slot[0] is not ZERO_TOKEN_USAGE:
+        usage = slot[0]
+
+    usage_token, slot_token = tokens
+    _token_usage_slot.reset(slot_token)
+    token_usage_context.reset(usage_token)
+    return usage
@@ -5,16 +5,80 @@ This module provides easy-to-use functions for tracking exceptions with Promethe
 """
 
 import logging
-import inspect
-import traceback
-from typing import Optional
+from typing import List, Optional, Tuple
 
+from fastapi_prometheus_middleware.batching import MetricBatch
 from fastapi_prometheus_middleware.metrics import APIMetrics
-from fastapi_prometheus_middleware.metrics_registry import get_metrics
+from fastapi_prometheus_middleware.metrics_registry import get_metrics, _add_reset_hook
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+# Seconds between flushes of batched exception counts
+EXCEPTION_FLUSH_INTERVAL = 1.0
+
+# Cached API metrics instance, resolved from the registry on first use
+_api_metrics: Optional[APIMetrics] = None
+
+
+def _reset() -> None:
+    """
+    Clear the cached API metrics instance.
+
+    Called whenever a metrics instance is registered in the metrics registry.
+    """
+    global _api_metrics
+    _api_metrics = None
+
+
+_add_reset_hook(_reset)
+
+
+def _get_api_metrics() -> APIMetrics:
+    """
+    Get the API metrics instance, resolving it from the registry on first use.
+
+    Returns:
+        The registered APIMetrics instance, or a default instance if none is registered
+    """
+    global _api_metrics
+
+    metrics = _api_metrics
+    if metrics is None:
+        metrics = get_metrics('api_metrics')
+        if not metrics:
+            # Fallback to a new instance if not found in registry
+            metrics = APIMetrics()
+            logger.warning("No API metrics found in registry, using default instance")
+        _api_metrics = metrics
+    return metrics
+
+
+def _apply_exception_counts(labels: Tuple[str, str, str], counts: List[int]) -> None:
+    """
+    Add batched exception counts to the Prometheus exception counter.
+
+    Args:
+        labels: The (exception_type, module, code) label values
+        counts: The batched counts for these labels
+    """
+    exception_type, module, code = labels
+    _get_api_metrics().track_exception_count(exception_type, module, code, sum(counts))
+
+
+# Pending exception counts keyed by (exception_type, module, code)
+_exception_batch = MetricBatch(_apply_exception_counts, EXCEPTION_FLUSH_INTERVAL)
+
+
+def flush_exception_counts() -> None:
+    """
+    Flush batched exception counts to the Prometheus exception counter.
+
+    Counts are also flushed periodically while exceptions are being tracked and
+    whenever the default registry is collected.
+    """
+    _exception_batch.flush()
+
 
 def track_global_exception():
     """
@@ -30,13 +94,9 @@ def track_global_exception():
             track_global_exception()
             # Handle the exception
     """
-    # Get the API metrics instance from the registry
-    metrics = get_metrics('api_metrics')
-    if not metrics:
-        # Fallback to a new instance if not found in registry
-        metrics = APIMetrics()
-        logger.warning("No API metrics found in registry, using default instance")
-
+    metrics = _api_metrics
+    if metrics is None:
+        metrics = _get_api_metrics()
     metrics.increment_global_exceptions()
 
 
@@ -59,23 +119,21 @@ def track_detailed_exception(exception: Exception, status_code: Optional[int] =
             # Handle the exception
     """
     try:
-        # Get the API metrics instance from the registry
-        metrics = get_metrics('api_metrics')
-        if not metrics:
-            # Fallback to a new instance if not found in registry
-            metrics = APIMetrics()
-            logger.warning("No API metrics found in registry, using default instance")
+        metrics = _api_metrics
+        if metrics is None:
+            metrics = _get_api_metrics()
+
+        # Batch the exception count; it is flushed to the counter periodically
+        _exception_batch.add(metrics.get_exception_labels(exception, status_code), 1)
 
-        # Track the exception with detailed information
-        metrics.track_exception(exception, status_code)
-
-        # Log the exception with traceback
-        logger.error(
-            f"Exception: {type(exception).__name__}: {str(exception)}",
-            extra={
-                "traceback": traceback.format_exc(),
-                "status_code": status_code
-            }
-        )
+        # Log the exception with traceback; formatting is left to the handlers
+        if logger.isEnabledFor(logging.ERROR):
+            logger.error(
+                "Exception: %s: %s",
+                type(exception).__name__,
+                exception,
+                exc_info=exception,
+                extra={"status_code": status_code}
+            )
     except Exception as e:
         logger.warning(f"Error tracking detailed exception: {e}")
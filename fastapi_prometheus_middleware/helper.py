@@ -4,8 +4,10 @@ Helper functions for Prometheus metrics.
 This module provides utility functions for working with Prometheus metrics.
 """
 
+import asyncio
 import logging
 import os
+import tempfile
 from typing import Optional
 
 from prometheus_client import generate_latest, REGISTRY
@@ -13,24 +15,62 @@ from prometheus_client import generate_latest, REGISTRY
 # Set up logging
 logger = logging.getLogger(__name__)
 
+# Process umask, read once so written files get the same mode as with open()
+_UMASK = os.umask(0)
+os.umask(_UMASK)
 
-async def generate_prometheus_data(file_path: Optional[str] = None):
+
+def _atomic_write_bytes(file_path: str, data: bytes) -> None:
+    """
+    Write bytes to a file atomically.
+
+    The data is written to a temporary file in the same directory which is then
+    renamed over the target, so readers never observe a partially written file.
+    The file gets the mode open() would give it, not the 0600 of mkstemp.
+
+    Args:
+        file_path: Path to the file to write
+        data: The bytes to write
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+        os.fchmod(fd, 0o666 & ~_UMASK)
+        os.close(fd)
+        fd = -1
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if fd != -1:
+            os.close(fd)
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+async def generate_prometheus_data(file_path: Optional[str] = None) -> Optional[bytes]:
     """
     Generate Prometheus metrics data and write it to a file.
-    
+
+    The file write runs in the default thread pool executor so the event loop
+    is not blocked while the data is written to disk.
+
     Args:
         file_path: Path to the file to write the metrics to (default: None)
-            If None, the function will return the metrics data as a string.
-            
+            If None, the function will return the metrics data as bytes.
+
     Returns:
-        The metrics data as a string if file_path is None, otherwise None.
+        The metrics data as bytes if file_path is None, otherwise None.
     """
-    data = generate_latest(registry=REGISTRY).decode('utf-8', errors='ignore')
-    
+    data = generate_latest(registry=REGISTRY)
+
     if file_path:
         try:
-            with open(file_path, mode='w', encoding='utf-8') as file:
-                file.write(data)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, _atomic_write_bytes, file_path, data)
         except Exception as e:
             logger.error(f"Error writing Prometheus data to file: {e}")
     else:
@@ -5,10 +5,11 @@ This module defines a class for tracking API performance and usage metrics.
 """
 
 import logging
-import inspect
-from typing import Dict, Any, Optional, List, Union
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List, Tuple
 
-from fastapi import Request, Response
+from fastapi import Request
 from prometheus_client import Counter, Histogram, Gauge, REGISTRY
 from prometheus_client.exposition import CONTENT_TYPE_LATEST
 from prometheus_client import generate_latest
@@ -16,6 +17,59 @@ from prometheus_client import generate_latest
 # Set up logging
 logger = logging.getLogger(__name__)
 
+# Maximum number of labeled metric children cached per APIMetrics instance
+CHILD_CACHE_SIZE = 10000
+
+# Metrics created by APIMetrics, keyed by metric name
+_metric_cache: Dict[str, Any] = {}
+
+# Seconds a rendered /metrics payload is reused across scrapes (0 disables caching)
+METRICS_CACHE_TTL = 1.0
+
+# Last rendered /metrics payload as (monotonic render time, payload)
+_last_render: Tuple[float, bytes] = (float('-inf'), b'')
+
+
+class _NullMetric:
+    """
+    Stand-in for a disabled metric or a labeled child that could not be created.
+
+    It accepts the labels()/inc()/dec()/observe() calls of a metric and discards them.
+    """
+
+    def labels(self, *args: Any, **kwargs: Any) -> "_NullMetric":
+        return self
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def dec(self, amount: float = 1) -> None:
+        pass
+
+    def observe(self, amount: float) -> None:
+        pass
+
+
+_NULL_METRIC = _NullMetric()
+
+# Precomputed label strings for HTTP status codes
+_STATUS_STRINGS = tuple(str(i) for i in range(600))
+
+
+def _status_str(status_code: int) -> str:
+    """
+    Get the label string for an HTTP status code without allocating for common codes.
+
+    Args:
+        status_code: The HTTP status code
+
+    Returns:
+        The status code as a string
+    """
+    if 0 <= status_code < 600:
+        return _STATUS_STRINGS[status_code]
+    return str(status_code)
+
 
 class APIMetrics:
     """
@@ -25,63 +79,80 @@ class APIMetrics:
     including request counts, durations, sizes, and errors.
     """
     
-    def __init__(self, prefix: str = 'fastapi'):
+    def __init__(self, prefix: str = 'fastapi', enable_size_histograms: bool = False):
         """
         Initialize the API metrics with the given prefix.
 
         Args:
             prefix: Prefix for all metric names (default: 'fastapi')
+            enable_size_histograms: Whether to track request and response sizes (default: False)
         """
         self.prefix = prefix
 
+        # Labeled metric children keyed by (metric id, label values)
+        self._child_cache: "OrderedDict[Tuple[int, Tuple[str, ...]], Any]" = OrderedDict()
+
         # Define Prometheus metrics with safe creation to avoid duplicates
-        self.http_request_counter = self._create_or_get_counter(
+        self.http_request_counter = self._create_or_get(
+            Counter,
             f'{prefix}_http_requests_total',
             'Total number of HTTP requests',
             ['method', 'endpoint', 'status_code']
         )
 
-        self.http_request_duration = self._create_or_get_histogram(
+        self.http_request_duration = self._create_or_get(
+            Histogram,
             f'{prefix}_http_request_duration_seconds',
             'HTTP request duration in seconds',
             ['method', 'endpoint'],
-            buckets=(0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0, 25.0, 50.0, 75.0, 100.0)
+            buckets=(0.005, 0.025, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
         )
 
-        self.active_requests = self._create_or_get_gauge(
+        self.active_requests = self._create_or_get(
+            Gauge,
             f'{prefix}_active_requests',
             'Number of active requests',
             ['method', 'endpoint']
         )
 
-        self.request_size = self._create_or_get_histogram(
-            f'{prefix}_request_size_bytes',
-            'Request size in bytes',
-            ['method', 'endpoint'],
-            buckets=(10, 100, 1000, 10000, 100000, 1000000)
-        )
-
-        self.response_size = self._create_or_get_histogram(
-            f'{prefix}_response_size_bytes',
-            'Response size in bytes',
-            ['method', 'endpoint', 'status_code'],
-            buckets=(10, 100, 1000, 10000, 100000, 1000000)
-        )
-
-        self.error_counter = self._create_or_get_counter(
+        # Size histograms add a series per bucket and label set, so they are opt-in
+        if enable_size_histograms:
+            self.request_size = self._create_or_get(
+                Histogram,
+                f'{prefix}_request_size_bytes',
+                'Request size in bytes',
+                ['method', 'endpoint'],
+                buckets=(10, 100, 1000, 10000, 100000, 1000000)
+            )
+
+            self.response_size = self._create_or_get(
+                Histogram,
+                f'{prefix}_response_size_bytes',
+                'Response size in bytes',
+                ['method', 'endpoint', 'status_code'],
+                buckets=(10, 100, 1000, 10000, 100000, 1000000)
+            )
+        else:
+            self.request_size = _NULL_METRIC
+            self.response_size = _NULL_METRIC
+
+        self.error_counter = self._create_or_get(
+            Counter,
             f'{prefix}_errors_total',
             'Total number of errors',
             ['method', 'endpoint', 'error_type']
         )
 
-        self.token_usage = self._create_or_get_counter(
+        self.token_usage = self._create_or_get(
+            Counter,
             f'{prefix}_token_usage_total',
             'Total number of tokens used',
             ['type']  # 'input', 'output', 'total'
         )
 
         # Add exception counter for tracking exceptions in different parts of the application
-        self.exception_counter = self._create_or_get_counter(
+        self.exception_counter = self._create_or_get(
+            Counter,
             f'{prefix}_exceptions_total',
             'Total number of exceptions',
             ['exception_type', 'module', 'code']
@@ -89,78 +160,43 @@ class APIMetrics:
 
         # Add a global exception counter for tracking total exceptions across the application
         # This counter has no labels to ensure it's a single global counter
-        self.global_exception_counter = self._create_or_get_counter(
+        self.global_exception_counter = self._create_or_get(
+            Counter,
             f'{prefix}_global_exceptions_total',
             'Total number of exceptions across the entire application',
             []
         )
 
-    def _create_or_get_counter(self, name: str, documentation: str, labelnames: Optional[List[str]] = None) -> Counter:
-        """
-        Create a new Counter or return an existing one with the same name.
-        
-        Args:
-            name: Metric name
-            documentation: Metric documentation
-            labelnames: List of label names
-            
-        Returns:
-            A Counter object
-        """
-        try:
-            return Counter(name, documentation, labelnames or [])
-        except ValueError:
-            # If the counter already exists, get it from the registry
-            for metric in REGISTRY._names_to_collectors.values():
-                if metric.name == name:
-                    return metric
-            # If we can't find it, create a new one with a slightly different name
-            return Counter(f"{name}_new", documentation, labelnames or [])
-
-    def _create_or_get_histogram(self, name: str, documentation: str, labelnames: Optional[List[str]] = None, buckets: Optional[tuple] = None) -> Histogram:
-        """
-        Create a new Histogram or return an existing one with the same name.
-        
-        Args:
-            name: Metric name
-            documentation: Metric documentation
-            labelnames: List of label names
-            buckets: Histogram buckets
-            
-        Returns:
-            A Histogram object
+        # Token usage children are fixed, so bind them once
+        self._tokens_input = self.token_usage.labels("input")
+        self._tokens_output = self.token_usage.labels("output")
+        self._tokens_total = self.token_usage.labels("total")
+
+    def _create_or_get(self, metric_class: type, name: str, documentation: str, labelnames: Optional[List[str]] = None, **kwargs: Any) -> Any:
         """
-        try:
-            return Histogram(name, documentation, labelnames or [], buckets=buckets)
-        except ValueError:
-            # If the histogram already exists, get it from the registry
-            for metric in REGISTRY._names_to_collectors.values():
-                if metric.name == name:
-                    return metric
-            # If we can't find it, create a new one with a slightly different name
-            return Histogram(f"{name}_new", documentation, labelnames or [], buckets=buckets)
-
-    def _create_or_get_gauge(self, name: str, documentation: str, labelnames: Optional[List[str]] = None) -> Gauge:
-        """
-        Create a new Gauge or return an existing one with the same name.
+        Create a new metric or return an existing one with the same name.
         
         Args:
+            metric_class: The metric class (Counter, Histogram or Gauge)
             name: Metric name
             documentation: Metric documentation
             labelnames: List of label names
+            **kwargs: Additional arguments for the metric class, e.g. buckets
             
         Returns:
-            A Gauge object
+            A metric of the given class
         """
-        try:
-            return Gauge(name, documentation, labelnames or [])
-        except ValueError:
-            # If the gauge already exists, get it from the registry
-            for metric in REGISTRY._names_to_collectors.values():
-                if metric.name == name:
-                    return metric
-            # If we can't find it, create a new one with a slightly different name
-            return Gauge(f"{name}_new", documentation, labelnames or [])
+        cached = _metric_cache.get(name)
+        if cached is not None:
+            return cached
+
+        # Reuse the metric if it is already registered, otherwise create it
+        metric = REGISTRY._names_to_collectors.get(name)
+        if metric is None:
+            metric = metric_class(name, documentation, labelnames or [], **kwargs)
+
+        _metric_cache[name] = metric
+        return metric
 
     def _get_endpoint(self, request: Request) -> str:
         """
@@ -172,29 +208,147 @@ class APIMetrics:
         Returns:
             The endpoint path
         """
-        route = getattr(request.scope.get('route'), 'path', None)
-        if route:
-            return route
-        
-        # Fallback to the request path if route is not available
-        return request.url.path
+        try:
+            route = getattr(request.scope.get('route'), 'path', None)
+            if route:
+                return route
+
+            # Fallback to the request path if route is not available
+            return request.url.path
+        except Exception as e:
+            logger.warning(f"Error getting endpoint: {e}")
+            return "unknown"
 
-    def _safe_labels(self, metric: Any, labels: Dict[str, str]) -> Any:
+    def _child(self, metric: Any, label_values: Tuple[str, ...]) -> Any:
         """
-        Safely apply labels to a metric, handling any errors.
-        
+        Get the labeled child of a metric, reusing cached children.
+
         Args:
             metric: The metric to label
-            labels: Dictionary of label names and values
-            
+            label_values: Label values in the order of the metric's label names
+
         Returns:
-            The labeled metric or None if an error occurred
+            The labeled metric, or a no-op metric if the labels are invalid
         """
-        try:
-            return metric.labels(**labels)
-        except (KeyError, ValueError) as e:
-            logger.warning(f"Error applying labels to metric: {e}")
-            return None
+        key = (id(metric), label_values)
+        cache = self._child_cache
+        child = cache.get(key)
+        if child is None:
+            try:
+                child = metric.labels(*label_values)
+            except (KeyError, ValueError) as e:
+                logger.warning(f"Error applying labels to metric: {e}")
+                child = _NULL_METRIC
+            cache[key] = child
+            if len(cache) > CHILD_CACHE_SIZE:
+                cache.popitem(last=False)
+        return child
+
+    def _track_started(self, method: str, endpoint: str, request_body_size: int) -> None:
+        """
+        Track the start of a request from precomputed label values.
+
+        Args:
+            method: The HTTP method
+            endpoint: The endpoint path
+            request_body_size: Size of the request body in bytes
+        """
+        # Track request size
+        self._child(self.request_size, (method, endpoint)).observe(request_body_size)
+
+        # Increment active requests gauge
+        self._child(self.active_requests, (method, endpoint)).inc()
+
+    def _track_completed(self, method: str, endpoint: str, status_code: int, duration: float, response_size: int = 0) -> None:
+        """
+        Track a completed request from precomputed label values.
+
+        Args:
+            method: The HTTP method
+            endpoint: The endpoint path
+            status_code: The HTTP status code of the response
+            duration: Request duration in seconds
+            response_size: Size of the response body in bytes (default: 0)
+        """
+        status_code = _status_str(status_code)
+
+        # Record request duration
+        self._child(self.http_request_duration, (method, endpoint)).observe(duration)
+
+        # Count request
+        self._child(self.http_request_counter, (method, endpoint, status_code)).inc()
+
+        # Track response size if available
+        if response_size:
+            self._child(self.response_size, (method, endpoint, status_code)).observe(response_size)
+
+    def _track_error(self, method: str, endpoint: str, status_code: int, error_type: str, duration: float) -> None:
+        """
+        Track a request that resulted in an error from precomputed label values.
+
+        Args:
+            method: The HTTP method
+            endpoint: The endpoint path
+            status_code: The HTTP status code
+            error_type: The type of error
+            duration: Request duration in seconds
+        """
+        status_code_str = _status_str(status_code)
+
+        # Record request duration
+        self._child(self.http_request_duration, (method, endpoint)).observe(duration)
+
+        # Count request
+        self._child(self.http_request_counter, (method, endpoint, status_code_str)).inc()
+
+        # Count error
+        self._child(self.error_counter, (method, endpoint, error_type)).inc()
+
+    def _track_finished(self, method: str, endpoint: str) -> None:
+        """
+        Track the end of a request (decrement active requests) from precomputed label values.
+
+        Args:
+            method: The HTTP method
+            endpoint: The endpoint path
+        """
+        # Decrement active requests gauge
+        self._child(self.active_requests, (method, endpoint)).dec()
+
+    def track_request_end(
+        self,
+        method: str,
+        endpoint: str,
+        status_code: int,
+        duration: float,
+        response_size: int = 0,
+        error_type: Optional[str] = None
+    ) -> None:
+        """
+        Track the outcome of a request in a single call from precomputed label values.
+
+        Records the duration and request count, and the response size or the error.
+        The active requests gauge is left to _track_finished, which callers run
+        even when the request is cancelled.
+
+        Args:
+            method: The HTTP method
+            endpoint: The endpoint path
+            status_code: The HTTP status code
+            duration: Request duration in seconds
+            response_size: Size of the response body in bytes (default: 0)
+            error_type: The type of error if the request failed (default: None)
+        """
+        status_code_str = _status_str(status_code)
+        child = self._child
+
+        child(self.http_request_duration, (method, endpoint)).observe(duration)
+        child(self.http_request_counter, (method, endpoint, status_code_str)).inc()
+
+        if error_type is not None:
+            child(self.error_counter, (method, endpoint, error_type)).inc()
+        elif response_size:
+            child(self.response_size, (method, endpoint, status_code_str)).observe(response_size)
 
     def track_request_started(self, request: Request, request_body_size: int) -> None:
         """
@@ -204,56 +358,28 @@ class APIMetrics:
             request: The FastAPI request object
             request_body_size: Size of the request body in bytes
         """
-        try:
-            method = request.method
-            endpoint = self._get_endpoint(request)
-
-            # Track request size
-            labeled_metric = self._safe_labels(self.request_size, {"method": method, "endpoint": endpoint})
-            if labeled_metric:
-                labeled_metric.observe(request_body_size)
-
-            # Increment active requests gauge
-            labeled_metric = self._safe_labels(self.active_requests, {"method": method, "endpoint": endpoint})
-            if labeled_metric:
-                labeled_metric.inc()
-        except Exception as e:
-            logger.warning(f"Error tracking request start: {e}")
+        self._track_started(request.method, self._get_endpoint(request), request_body_size)
 
-    def track_request_completed(self, request: Request, response: Response, duration: float) -> None:
+    def track_request_completed(self, request: Request, response: Any, duration: float, response_size: int = 0) -> None:
         """
         Track a completed request.
 
         Args:
             request: The FastAPI request object
-            response: The response object
+            response: The response object, or the HTTP status code of the response
             duration: Request duration in seconds
+            response_size: Size of the response body in bytes, used when response is
+                a status code (default: 0)
         """
-        try:
-            method = request.method
-            endpoint = self._get_endpoint(request)
-            status_code = str(response.status_code)
-
-            # Record request duration
-            labeled_metric = self._safe_labels(self.http_request_duration, {"method": method, "endpoint": endpoint})
-            if labeled_metric:
-                labeled_metric.observe(duration)
-
-            # Count request
-            labeled_metric = self._safe_labels(self.http_request_counter,
-                                             {"method": method, "endpoint": endpoint, "status_code": status_code})
-            if labeled_metric:
-                labeled_metric.inc()
-
-            # Track response size if available
-            if hasattr(response, 'body') and response.body:
-                response_size = len(response.body)
-                labeled_metric = self._safe_labels(self.response_size,
-                                                 {"method": method, "endpoint": endpoint, "status_code": status_code})
-                if labeled_metric:
-                    labeled_metric.observe(response_size)
-        except Exception as e:
-            logger.warning(f"Error tracking request completion: {e}")
+        if isinstance(response, int):
+            status_code = response
+        else:
+            status_code = response.status_code
+            body = getattr(response, 'body', None)
+            if body:
+                response_size = len(body)
+
+        self._track_completed(request.method, self._get_endpoint(request), status_code, duration, response_size)
 
     def track_request_error(self, request: Request, status_code: int, error_type: str, duration: float) -> None:
         """
@@ -265,29 +391,7 @@ class APIMetrics:
             error_type: The type of error
             duration: Request duration in seconds
         """
-        try:
-            method = request.method
-            endpoint = self._get_endpoint(request)
-            status_code_str = str(status_code)
-
-            # Record request duration
-            labeled_metric = self._safe_labels(self.http_request_duration, {"method": method, "endpoint": endpoint})
-            if labeled_metric:
-                labeled_metric.observe(duration)
-
-            # Count request
-            labeled_metric = self._safe_labels(self.http_request_counter,
-                                             {"method": method, "endpoint": endpoint, "status_code": status_code_str})
-            if labeled_metric:
-                labeled_metric.inc()
-
-            # Count error
-            labeled_metric = self._safe_labels(self.error_counter,
-                                             {"method": method, "endpoint": endpoint, "error_type": error_type})
-            if labeled_metric:
-                labeled_metric.inc()
-        except Exception as e:
-            logger.warning(f"Error tracking request error: {e}")
+        self._track_error(request.method, self._get_endpoint(request), status_code, error_type, duration)
 
     def track_request_finished(self, request: Request) -> None:
         """
@@ -296,16 +400,7 @@ class APIMetrics:
         Args:
             request: The FastAPI request object
         """
-        try:
-            method = request.method
-            endpoint = self._get_endpoint(request)
-
-            # Decrement active requests gauge
-            labeled_metric = self._safe_labels(self.active_requests, {"method": method, "endpoint": endpoint})
-            if labeled_metric:
-                labeled_metric.dec()
-        except Exception as e:
-            logger.warning(f"Error tracking request finish: {e}")
+        self._track_finished(request.method, self._get_endpoint(request))
 
     def track_token_usage(self, input_tokens: int = 0, output_tokens: int = 0, total_tokens: int = 0) -> None:
         """
@@ -318,22 +413,47 @@ class APIMetrics:
         """
         try:
             # Track input tokens
-            labeled_metric = self._safe_labels(self.token_usage, {"type": "input"})
-            if labeled_metric:
-                labeled_metric.inc(input_tokens)
+            if input_tokens:
+                self._tokens_input.inc(input_tokens)
 
             # Track output tokens
-            labeled_metric = self._safe_labels(self.token_usage, {"type": "output"})
-            if labeled_metric:
-                labeled_metric.inc(output_tokens)
+            if output_tokens:
+                self._tokens_output.inc(output_tokens)
 
             # Track total tokens
-            labeled_metric = self._safe_labels(self.token_usage, {"type": "total"})
-            if labeled_metric:
-                labeled_metric.inc(total_tokens)
+            if total_tokens:
+                self._tokens_total.inc(total_tokens)
         except Exception as e:
             logger.warning(f"Error tracking token usage: {e}")
 
+    def get_exception_labels(self, exception: Exception, status_code: Optional[int] = None) -> Tuple[str, str, str]:
+        """
+        Get the exception counter label values for an exception.
+
+        Args:
+            exception: The exception to describe
+            status_code: The HTTP status code (optional)
+
+        Returns:
+            A tuple of (exception_type, module, code) label values
+        """
+        # Get exception details
+        exception_type = type(exception).__name__
+
+        # Get the module where the exception occurred from the innermost traceback frame
+        tb = exception.__traceback__
+        if tb is None:
+            module = 'unknown'
+        else:
+            while tb.tb_next is not None:
+                tb = tb.tb_next
+            module = tb.tb_frame.f_globals.get('__name__', 'unknown')
+
+        # Use status code as code if available, otherwise use 0
+        code = _status_str(status_code) if status_code is not None else "0"
+
+        return exception_type, module, code
+
     def track_exception(self, exception: Exception, status_code: Optional[int] = None) -> None:
         """
         Track an exception with detailed information.
@@ -343,49 +463,53 @@ class APIMetrics:
             status_code: The HTTP status code (optional)
         """
         try:
-            # Get exception details
-            exception_type = type(exception).__name__
-            
-            # Get the module where the exception occurred
-            frame = inspect.trace()[-1]
-            module = frame.frame.f_globals.get('__name__', 'unknown')
-            
-            # Use status code as code if available, otherwise use 0
-            code = str(status_code) if status_code is not None else "0"
-            
-            # Increment exception counter
-            labeled_metric = self._safe_labels(self.exception_counter, {
-                "exception_type": exception_type,
-                "module": module,
-                "code": code
-            })
-            if labeled_metric:
-                labeled_metric.inc()
+            exception_type, module, code = self.get_exception_labels(exception, status_code)
+            self.track_exception_count(exception_type, module, code)
         except Exception as e:
             logger.warning(f"Error tracking exception: {e}")
 
+    def track_exception_count(self, exception_type: str, module: str, code: str, count: int = 1) -> None:
+        """
+        Increment the exception counter for the given labels.
+
+        Args:
+            exception_type: The exception type name
+            module: The module where the exception occurred
+            code: The status code as a string
+            count: Number of exceptions to add (default: 1)
+        """
+        self._child(self.exception_counter, (exception_type, module, code)).inc(count)
+
     def increment_global_exceptions(self) -> None:
         """
         Increment the global exception counter.
         """
-        try:
-            self.global_exception_counter.inc()
-        except Exception as e:
-            logger.warning(f"Error incrementing global exception counter: {e}")
+        self.global_exception_counter.inc()
 
 
 async def metrics_endpoint(request=None):
     """
     Endpoint for exposing Prometheus metrics.
 
+    The rendered payload is reused for METRICS_CACHE_TTL seconds, so concurrent
+    or back-to-back scrapes (e.g. from HA Prometheus pairs) render it only once.
+
     Args:
         request: The FastAPI request object (optional)
 
     Returns:
         Response: A response containing the latest Prometheus metrics.
     """
+    global _last_render
     from fastapi import Response
+
+    now = time.monotonic()
+    rendered_at, payload = _last_render
+    if now - rendered_at >= METRICS_CACHE_TTL:
+        payload = generate_latest(REGISTRY)
+        _last_render = (now, payload)
+
     return Response(
-        generate_latest(REGISTRY),
+        payload,
         media_type=CONTENT_TYPE_LATEST
     )
@@ -5,13 +5,32 @@ This module provides a registry for metrics instances to be used across the appl
 """
 
 import logging
-from typing import Optional, Dict, Any
+import threading
+from types import MappingProxyType
+from typing import Optional, Mapping, Any, Callable, List
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
-# Global registry for metrics instances
+# Global registry for metrics instances. Writes take the lock; reads do not,
+# since single-key dict lookups are atomic in CPython.
 _metrics_registry = {}
+_registry_lock = threading.Lock()
+
+# Callbacks invoked whenever a metrics instance is registered
+_reset_hooks: List[Callable[[], None]] = []
+
+
+def _add_reset_hook(hook: Callable[[], None]) -> None:
+    """
+    Add a callback that is invoked whenever a metrics instance is registered.
+
+    Modules that cache registry lookups use this to invalidate their cache.
+
+    Args:
+        hook: Callback taking no arguments
+    """
+    _reset_hooks.append(hook)
 
 
 def register_metrics(name: str, instance: Any) -> None:
@@ -22,7 +41,10 @@ def register_metrics(name: str, instance: Any) -> None:
         name: Name to register the instance under
         instance: The metrics instance to register
     """
-    _metrics_registry[name] = instance
+    with _registry_lock:
+        _metrics_registry[name] = instance
+        for hook in _reset_hooks:
+            hook()
 
 
 def get_metrics(name: str) -> Optional[Any]:
@@ -38,11 +60,11 @@ def get_metrics(name: str) -> Optional[Any]:
     return _metrics_registry.get(name)
 
 
-def get_all_metrics() -> Dict[str, Any]:
+def get_all_metrics() -> Mapping[str, Any]:
     """
     Get all registered metrics instances.
     
     Returns:
-        Dictionary of all registered metrics instances
+        Read-only live view of all registered metrics instances
     """
-    return _metrics_registry.copy()
+    return MappingProxyType(_metrics_registry)
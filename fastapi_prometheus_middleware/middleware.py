@@ -4,30 +4,39 @@ Prometheus middleware for FastAPI applications.
 This module provides a middleware that tracks request metrics using Prometheus.
 """
 from datetime import datetime
+import fnmatch
+import logging
+import re
 import time
 import typing
-from typing import Callable, List, Optional, Dict, Any
+from collections import OrderedDict
+from typing import List, Optional, Dict, Any, Tuple
 
 from pydantic import BaseModel, Field
 
 try:
     import orjson
+    _loads = orjson.loads
 except ImportError:
-    import json as orjson
-    orjson.loads = orjson.loads
-    orjson.dumps = lambda obj, **kwargs: orjson.dumps(obj).encode('utf-8')
+    import json
+    _loads = json.loads
 
 from fastapi import Request, Response
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.types import ASGIApp
-from starlette.responses import StreamingResponse
+from starlette.datastructures import Headers
+from starlette.routing import Host, Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-from fastapi_prometheus_middleware.context import token_usage_context
+from fastapi_prometheus_middleware.context import start_token_tracking, finish_token_tracking
 from fastapi_prometheus_middleware.metrics import APIMetrics
 from fastapi_prometheus_middleware.streaming_metrics import StreamingMetrics
 from fastapi_prometheus_middleware.metrics_registry import register_metrics
+from fastapi_prometheus_middleware import exception_tracker
 from fastapi_prometheus_middleware.exception_tracker import track_detailed_exception
 
+# Maximum number of request paths whose matched route template is cached
+ENDPOINT_CACHE_SIZE = 10000
+
+
 class UserData(BaseModel):
     userId: int = Field(..., alias="_id")
     orgId: typing.Optional[int] = None
@@ -45,9 +54,34 @@ class UserData(BaseModel):
     workspace: typing.List[typing.Dict]
 
 
-class PrometheusMiddleware(BaseHTTPMiddleware):
+class _LazyUserData:
+    """
+    Stand-in for the UserData of a request that parses the x-user-data header on first use.
+
+    Endpoints that never read request.state.user_data pay no parsing cost.
+    Attribute access is delegated to the parsed UserData, so an invalid header
+    raises ValueError when the user data is first used.
+    """
+
+    __slots__ = ("_raw", "_user_data")
+
+    def __init__(self, raw: str):
+        self._raw = raw
+        self._user_data: Optional[UserData] = None
+
+    def __getattr__(self, name: str) -> Any:
+        user_data = self._user_data
+        if user_data is None:
+            user_data = self._user_data = UserData.model_construct(**_loads(self._raw))
+        return getattr(user_data, name)
+
+
+class PrometheusMiddleware:
     """
     Middleware for tracking FastAPI request metrics with Prometheus.
+
+    This is a pure ASGI middleware, so it adds no extra task or memory
+    streams per request.
     
     This middleware tracks:
     - Request counts
@@ -66,6 +100,10 @@ class PrometheusMiddleware(BaseHTTPMiddleware):
         prefix: str = "fastapi",
         skip_paths: Optional[List[str]] = None,
         logger: Any = None,
+        capture_body: bool = True,
+        max_body_bytes: int = 65536,
+        enable_size_histograms: bool = False,
+        enable_token_tracking: bool = True,
         **kwargs
     ):
         """
@@ -74,23 +112,98 @@ class PrometheusMiddleware(BaseHTTPMiddleware):
         Args:
             app: The ASGI application
             prefix: Prefix for Prometheus metrics (default: "fastapi")
-            skip_paths: List of paths to skip tracking (default: ["/metrics", "/_readyz", "/_healthz"])
+            skip_paths: List of paths to skip tracking, glob patterns such as "/static/*"
+                are supported (default: ["/metrics", "/_readyz", "/_healthz"])
             logger: Logger instance to use for logging (default: None)
-            **kwargs: Additional arguments to pass to the parent class
+            capture_body: Whether to include JSON request bodies in logs (default: True)
+            max_body_bytes: Maximum size of a request body to read for logging (default: 65536)
+            enable_size_histograms: Whether to track request and response sizes (default: False)
+            enable_token_tracking: Whether to collect token usage reported by endpoints
+                with set_token_usage (default: True)
+            **kwargs: Additional arguments (ignored, accepted for backward compatibility)
         """
-        super().__init__(app)
+        self.app = app
         self.prefix = prefix
-        self.skip_paths = skip_paths or ["/metrics", "/_readyz", "/_healthz"]
+        # Exact paths are stored as a frozenset so the per-request check is a single
+        # hash lookup; glob patterns are compiled into one regular expression
+        skip_paths = skip_paths or ("/metrics", "/_readyz", "/_healthz")
+        skip_globs = [path for path in skip_paths if any(char in path for char in "*?[")]
+        self.skip_paths = frozenset(path for path in skip_paths if path not in skip_globs)
+        self._skip_re = re.compile("|".join(fnmatch.translate(path) for path in skip_globs)) if skip_globs else None
         self.logger = logger
+        self.capture_body = capture_body
+        self.max_body_bytes = max_body_bytes
+        self.track_tokens = enable_token_tracking
+
+        # Matched route template keyed by (method, root path, path), see get_endpoint
+        self._endpoint_cache: "OrderedDict[Tuple[str, str, str], str]" = OrderedDict()
 
         # Create metrics instances with the correct prefix
-        self.api_metrics = APIMetrics(prefix=prefix)
+        self.api_metrics = APIMetrics(prefix=prefix, enable_size_histograms=enable_size_histograms)
         self.streaming_metrics = StreamingMetrics(prefix=prefix)
 
         # Register metrics instances in the registry
         register_metrics('api_metrics', self.api_metrics)
         register_metrics('streaming_metrics', self.streaming_metrics)
 
+        # Hand the API metrics to the exception tracker so it skips the registry lookup
+        exception_tracker._api_metrics = self.api_metrics
+
+    def should_skip(self, path: str) -> bool:
+        """
+        Check whether a request path should be skipped.
+
+        Args:
+            path: The request path
+
+        Returns:
+            True if the path matches one of the skip paths
+        """
+        return path in self.skip_paths or (self._skip_re is not None and self._skip_re.match(path) is not None)
+
+    def get_endpoint(self, scope: Scope) -> str:
+        """
+        Get the endpoint label for a request.
+
+        The route template (e.g. "/items/{item_id}") is used when a route of the
+        application matches, so dynamic path segments don't create new series.
+        The route is resolved once, before the router runs, so every metric of
+        the request uses the same label. Matched templates are cached per request
+        path, so repeated paths skip matching against every route.
+
+        Args:
+            scope: The ASGI connection scope
+
+        Returns:
+            The route path, or the request path if no route matches
+        """
+        route = scope.get("route")
+        if route is not None:
+            return route.path
+
+        key = (scope["method"], scope.get("root_path", ""), scope["path"])
+        cache = self._endpoint_cache
+        endpoint = cache.get(key)
+        if endpoint is not None:
+            return endpoint
+
+        router = getattr(scope.get("app"), "router", None)
+        partial_path = None
+        for route in getattr(router, "routes", ()):
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                # Only full matches are cached, so routes added later are still found.
+                # Host routes also depend on the Host header, so they are not cached
+                if not isinstance(route, Host):
+                    cache[key] = route.path
+                    if len(cache) > ENDPOINT_CACHE_SIZE:
+                        cache.popitem(last=False)
+                return route.path
+            if match == Match.PARTIAL and partial_path is None:
+                partial_path = route.path
+
+        return partial_path or scope["path"]
+
     async def process_request_data(self, request: Request) -> Dict[str, Any]:
         """
         Process and extract data from the request.
@@ -109,71 +222,110 @@ class PrometheusMiddleware(BaseHTTPMiddleware):
             'path_params': dict(request.path_params.items()),
             'query_params': dict(request.query_params.items()),
             'headers': dict(request.headers.items()),
-            'request_body': await request.body()
+            'request_body': b''
         }
         return request_data
 
-    def process_request_headers(self, request: Request, request_data: Dict[str, Any]) -> None:
+    def get_request_body_size(self, request: Request) -> int:
+        """
+        Get the request body size from the Content-Length header.
+
+        The body itself is not read, so streaming uploads are not buffered.
+
+        Args:
+            request: The FastAPI request object
+
+        Returns:
+            The request body size in bytes, or 0 if unknown
+        """
+        try:
+            return int(request.headers.get("content-length") or 0)
+        except ValueError:
+            return 0
+
+    async def process_request_headers(self, request: Request, request_data: Dict[str, Any]) -> bytes:
         """
         Process request headers and update request data.
-        
+
+        The request body is only read when it will be logged: a logger is set,
+        body capture is enabled, and the body is JSON within max_body_bytes.
+
         Args:
             request: The FastAPI request object
             request_data: The request data dictionary to update
+
+        Returns:
+            The raw request body if it was read, otherwise empty bytes
         """
         content_type = request.headers.get("content-type", "")
+        body = b''
         try:
-            request_data['request_body'] = (
-                orjson.loads(request_data['request_body'])
-                if request_data['request_body'] and not content_type.startswith("multipart/form-data")
-                else {}
-            )
+            if (
+                self.logger
+                and self.capture_body
+                and content_type.startswith("application/json")
+                and 0 < self.get_request_body_size(request) <= self.max_body_bytes
+            ):
+                body = await request.body()
+            request_data['request_body'] = _loads(body) if body else {}
             if x_user_data := request.headers.get("x-user-data"):
-                request.state.user_data = UserData.construct(**orjson.loads(x_user_data))
+                request.state.user_data = _LazyUserData(x_user_data)
 
         except (ValueError, TypeError):
             request_data['request_body'] = {}
 
-    def process_response(self, request: Request, response: Response, request_data: Dict[str, Any], start_time: float) -> Dict[str, Any]:
+        return body
+
+    def process_response(
+        self,
+        status_code: int,
+        headers: Headers,
+        body: bytes,
+        is_streaming: bool,
+        request_data: Dict[str, Any],
+        duration: float
+    ) -> Dict[str, Any]:
         """
         Process the response and extract data.
-        
+
         Args:
-            request: The FastAPI request object
-            response: The response object
+            status_code: The HTTP status code of the response
+            headers: The response headers
+            body: The captured response body (empty if not captured)
+            is_streaming: Whether the response body was sent in multiple chunks
             request_data: The request data dictionary
-            start_time: The start time of the request
-            
+            duration: The request duration in seconds
+
         Returns:
             A dictionary containing response data
         """
-        end_time = time.perf_counter()
-        request_data['request_duration'] = end_time - start_time
+        request_data['request_duration'] = duration
 
-        if isinstance(response, StreamingResponse):
+        if is_streaming:
             return {
-                'status_code': response.status_code, 
+                'status_code': status_code,
                 'body': {
                     'data': 'streaming response'
                 }
             }
-        elif hasattr(response, 'template'):
+
+        content_type = headers.get("content-type", "")
+        if not content_type.startswith("application/json"):
             return {
-                'status_code': response.status_code,
-                'body': {'template': 'template response'}
+                'status_code': status_code,
+                'body': {'content_type': content_type}
+            }
+
+        try:
+            return {
+                'status_code': status_code,
+                'body': _loads(body) if body else ''
+            }
+        except (ValueError, TypeError):
+            return {
+                'status_code': status_code,
+                'body': body.decode('utf-8', errors='replace')
             }
-        else:
-            try:
-                body = response.body.decode('utf-8') if hasattr(response, 'body') and response.body else ''
-                return {
-                    'status_code': response.status_code,
-                    'body': orjson.loads(body) if body else ''
-                }
-            except (AttributeError, ValueError, TypeError):
-                return {
-                    'status_code': response.status_code,
-                    'body': str(response)
-                }
 
     def log_request(self, level: str, request_data: Dict[str, Any], response_data: Dict[str, Any], request_time: float) -> None:
         """
@@ -185,9 +337,9 @@ class PrometheusMiddleware(BaseHTTPMiddleware):
             response_data: The response data dictionary
             request_time: The request duration in seconds
         """
-        if not self.logger:
+        if not self.logger or not self.logger.isEnabledFor(logging.INFO if level == "info" else logging.ERROR):
             return
-            
+
         log_data = {
             "status": response_data.get('status_code', 200),
             'apiTime': request_time,
@@ -200,7 +352,7 @@ class PrometheusMiddleware(BaseHTTPMiddleware):
         else:
             self.logger.error(log_data)
 
-    async def handle_exception(self, request: Request, request_data: Dict[str, Any], exc: Exception, status_code: int, start_time: float) -> Response:
+    async def handle_exception(self, request: Request, request_data: Dict[str, Any], exc: Exception, status_code: int, duration: float) -> Response:
         """
         Handle exceptions that occur during request processing.
         
@@ -209,7 +361,7 @@ class PrometheusMiddleware(BaseHTTPMiddleware):
             request_data: The request data dictionary
             exc: The exception that occurred
             status_code: The HTTP status code to return
-            start_time: The start time of the request
+            duration: The request duration in seconds
             
         Returns:
             A response object
@@ -217,8 +369,7 @@ class PrometheusMiddleware(BaseHTTPMiddleware):
         from fastapi.responses import JSONResponse
         
         request_data["error"] = [str(exc)] if not isinstance(exc, list) else exc
-        end_time = time.perf_counter()
-        request_data['request_duration'] = end_time - start_time
+        request_data['request_duration'] = duration
         
         if self.logger:
             self.logger.exception(
@@ -232,65 +383,143 @@ class PrometheusMiddleware(BaseHTTPMiddleware):
             "error_response": error_response
         }
         
-        self.log_request("error", request_data, response_obj, end_time - start_time)
+        self.log_request("error", request_data, response_obj, duration)
         return JSONResponse(content=error_response, status_code=status_code)
 
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
         """
         Process the request and track metrics.
-        
+
         Args:
-            request: The FastAPI request object
-            call_next: The next middleware or endpoint to call
-            
-        Returns:
-            The response from the next middleware or endpoint
+            scope: The ASGI connection scope
+            receive: The ASGI receive channel
+            send: The ASGI send channel
         """
-        if request.url.path in self.skip_paths:
-            return await call_next(request)
+        if scope["type"] != "http" or self.should_skip(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope, receive)
+        method = scope["method"]
+        endpoint = self.get_endpoint(scope)
 
         # Initialize token usage context
-        token_usage_context.set({"total_tokens": 0, "input_tokens": 0, "output_tokens": 0})
+        token_tracking = start_token_tracking() if self.track_tokens else None
         start_time = time.perf_counter()
 
-        # Process request data
-        request_data = await self.process_request_data(request)
-        
+        # Process request data; the full request data is only needed for logging
+        if self.logger is not None:
+            request_data = await self.process_request_data(request)
+        else:
+            request_data = {'url_path': scope["path"], 'request_method': method}
+
         # Track request start
-        request_body_size = len(request_data.get('request_body', b''))
-        self.api_metrics.track_request_started(request, request_body_size)
+        request_body_size = self.get_request_body_size(request)
+        self.api_metrics._track_started(method, endpoint, request_body_size)
+
+        response_started = False
+        status_code = 500
+        response_headers = Headers()
+        response_size = 0
+        response_chunks = 0
+        response_body = bytearray()
+        # Responses are only processed for the info log, so skip capturing them
+        # when that level is disabled
+        log_responses = self.logger is not None and self.logger.isEnabledFor(logging.INFO)
+        capture_response = log_responses
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal response_started, status_code, response_headers, response_size, response_chunks, capture_response
+
+            if message["type"] == "http.response.start":
+                response_started = True
+                status_code = message["status"]
+                response_headers = Headers(raw=message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                body = message.get("body", b"")
+                response_size += len(body)
+                response_chunks += 1
+                if capture_response:
+                    if len(response_body) + len(body) <= self.max_body_bytes:
+                        response_body.extend(body)
+                    else:
+                        capture_response = False
+                        response_body.clear()
+
+            await send(message)
 
         try:
-            self.process_request_headers(request, request_data)
-            response = await call_next(request)
-            response_data = self.process_response(request, response, request_data, start_time)
-            self.log_request("info", request_data, response_data, time.perf_counter() - start_time)
+            body = await self.process_request_headers(request, request_data)
+            if body:
+                receive = self._replay_body(body, receive)
 
-            # Track successful completion
-            duration = time.perf_counter() - start_time
-            self.api_metrics.track_request_completed(request, response, duration)
+            await self.app(scope, receive, send_wrapper)
 
-            return response
+            # Track successful completion
+            end_time = time.perf_counter()
+            duration = end_time - start_time
+            if log_responses:
+                response_data = self.process_response(
+                    status_code,
+                    response_headers,
+                    bytes(response_body),
+                    response_chunks > 1,
+                    request_data,
+                    duration
+                )
+                self.log_request("info", request_data, response_data, duration)
+            self.api_metrics.track_request_end(method, endpoint, status_code, duration, response_size)
 
         except Exception as exc:
-            duration = time.perf_counter() - start_time
-            status_code = getattr(exc, 'status_code', 500)
-            self.api_metrics.track_request_error(request, status_code, type(exc).__name__, duration)
+            end_time = time.perf_counter()
+            duration = end_time - start_time
+            error_status_code = getattr(exc, 'status_code', 500)
+            self.api_metrics.track_request_end(
+                method, endpoint, error_status_code, duration, error_type=type(exc).__name__
+            )
             # Use our metrics instance for tracking exceptions
-            self.api_metrics.track_exception(exc, status_code)
-            return await self.handle_exception(request, request_data, exc, status_code, start_time)
+            self.api_metrics.track_exception(exc, error_status_code)
+
+            if response_started:
+                # The response is already on its way, so it can't be replaced
+                raise
+
+            response = await self.handle_exception(request, request_data, exc, error_status_code, duration)
+            await response(scope, receive, send)
 
         finally:
-            self.api_metrics.track_request_finished(request)
+            # Decrement active requests here, so cancelled requests are not left counted
+            self.api_metrics._track_finished(method, endpoint)
 
             # Track token usage
-            token_data = token_usage_context.get()
-            if token_data["total_tokens"] > 0:
-                self.api_metrics.track_token_usage(
-                    input_tokens=token_data["input_tokens"],
-                    output_tokens=token_data["output_tokens"],
-                    total_tokens=token_data["total_tokens"]
-                )
+            if token_tracking is not None:
+                token_data = finish_token_tracking(token_tracking)
+                if token_data.total_tokens > 0:
+                    self.api_metrics.track_token_usage(
+                        input_tokens=token_data.input_tokens,
+                        output_tokens=token_data.output_tokens,
+                        total_tokens=token_data.total_tokens
+                    )
+
+    @staticmethod
+    def _replay_body(body: bytes, receive: Receive) -> Receive:
+        """
+        Create a receive channel that replays an already read request body.
+
+        Args:
+            body: The request body that was read by the middleware
+            receive: The original ASGI receive channel
+
+        Returns:
+            A receive channel that returns the body first, then defers to receive
+        """
+        body_sent = False
+
+        async def replay_receive() -> Message:
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
 
-            # Reset token usage context
-            token_usage_context.set({"total_tokens": 0, "input_tokens": 0, "output_tokens": 0})
+        return replay_receive
@@ -4,17 +4,156 @@ Prometheus metrics for streaming responses.
 This module defines metrics and utilities for tracking streaming response performance.
 """
 
-import time
+import re
 import logging
-import inspect
-from typing import AsyncGenerator, Any, Optional, Callable, Dict, List, Union
+from collections import namedtuple
+from typing import Any, Iterable, Optional, Dict, List, Tuple
 
 from prometheus_client import Counter, Histogram, Gauge, REGISTRY
-from fastapi import Request
+from prometheus_client.core import CounterMetricFamily
+
+from fastapi_prometheus_middleware.batching import MetricBatch
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+# Maximum number of distinct endpoint label values per StreamingMetrics instance
+MAX_ENDPOINTS = 1000
+
+# Maximum length of an endpoint label value
+MAX_ENDPOINT_LENGTH = 120
+
+# Endpoint label value used once MAX_ENDPOINTS distinct endpoints have been seen
+OVERFLOW_ENDPOINT = "__overflow__"
+
+# Characters that are replaced in endpoint label values
+_INVALID_ENDPOINT_CHARS = re.compile(r"[^A-Za-z0-9_./{}:-]")
+
+# Default buckets for the stream duration histogram, in seconds
+STREAM_DURATION_BUCKETS = (0.5, 2.0, 10.0, 30.0, 120.0, 600.0)
+
+# Seconds between flushes of batched stream durations
+DURATION_FLUSH_INTERVAL = 0.25
+
+# Labeled metric children for one endpoint, bound once and reused for every stream
+StreamChildren = namedtuple("StreamChildren", ["active", "chunks", "bytes", "duration"])
+
+
+class _CounterValue:
+    """
+    Value of one labeled _UnlockedCounter child.
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        if amount < 0:
+            raise ValueError("Counters can only be incremented by non-negative amounts.")
+        self.value += amount
+
+
+class _UnlockedCounter:
+    """
+    Labeled counter whose values are plain numbers read when Prometheus scrapes.
+
+    Unlike prometheus_client.Counter, inc() takes no lock. It is used for the
+    stream chunk and byte counts, which are only updated from streaming
+    generators running on the event loop. labels(), remove(), clear() and
+    inc() otherwise behave like those of prometheus_client.Counter.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        """
+        Initialize the counter and register it with the default registry.
+
+        Args:
+            name: Metric name
+            documentation: Metric documentation
+            labelnames: List of label names
+        """
+        self._name = name
+        self._documentation = documentation
+        self._labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], _CounterValue] = {}
+        REGISTRY.register(self)
+
+    def labels(self, *labelvalues: Any, **labelkwargs: Any) -> _CounterValue:
+        """
+        Get the child for the given label values, creating it on first use.
+
+        Args:
+            *labelvalues: Label values in the order of the label names
+            **labelkwargs: Label values by label name, instead of labelvalues
+
+        Returns:
+            The counter child
+        """
+        value = None if labelkwargs else self._values.get(labelvalues)
+        if value is None:
+            labelvalues = self._label_values(labelvalues, labelkwargs)
+            value = self._values.setdefault(labelvalues, _CounterValue())
+        return value
+
+    def remove(self, *labelvalues: Any) -> None:
+        """
+        Remove the child for the given label values.
+
+        Args:
+            *labelvalues: Label values in the order of the label names
+        """
+        self._values.pop(self._label_values(labelvalues, {}), None)
+
+    def clear(self) -> None:
+        """
+        Remove all children.
+        """
+        self._values.clear()
+
+    def _label_values(self, labelvalues: Tuple[Any, ...], labelkwargs: Dict[str, Any]) -> Tuple[str, ...]:
+        """
+        Validate label values and convert them to strings.
+
+        Args:
+            labelvalues: Label values in the order of the label names
+            labelkwargs: Label values by label name
+
+        Returns:
+            The label values as strings, in the order of the label names
+        """
+        if labelvalues and labelkwargs:
+            raise ValueError("Can't pass both *args and **kwargs")
+        if labelkwargs:
+            if sorted(labelkwargs) != sorted(self._labelnames):
+                raise ValueError("Incorrect label names")
+            labelvalues = tuple(labelkwargs[name] for name in self._labelnames)
+        elif len(labelvalues) != len(self._labelnames):
+            raise ValueError("Incorrect label count")
+        return tuple(str(value) for value in labelvalues)
+
+    def describe(self) -> List[CounterMetricFamily]:
+        return [CounterMetricFamily(self._name, self._documentation, labels=self._labelnames)]
+
+    def collect(self) -> List[CounterMetricFamily]:
+        family = CounterMetricFamily(self._name, self._documentation, labels=self._labelnames)
+        for labelvalues, value in list(self._values.items()):
+            family.add_metric(labelvalues, value.value)
+        return [family]
+
+
+def _observe_durations(duration_child: Any, durations: List[float]) -> None:
+    """
+    Observe batched stream durations on a duration histogram child.
+
+    Args:
+        duration_child: The labeled duration histogram child of an endpoint
+        durations: The batched durations in seconds
+    """
+    for duration in durations:
+        duration_child.observe(duration)
+
 
 class StreamingMetrics:
     """
@@ -24,147 +163,155 @@ class StreamingMetrics:
     including active streams, chunk counts, bytes sent, duration, and errors.
     """
     
-    def __init__(self, prefix: str = 'fastapi'):
+    def __init__(
+        self,
+        prefix: str = 'fastapi',
+        max_endpoints: int = MAX_ENDPOINTS,
+        buckets: Optional[tuple] = None
+    ):
         """
         Initialize the streaming metrics with the given prefix.
         
         Args:
             prefix: Prefix for all metric names (default: 'fastapi')
+            max_endpoints: Maximum number of distinct endpoint label values; further
+                endpoints are tracked as "__overflow__" (default: 1000)
+            buckets: Buckets for the stream duration histogram in seconds
+                (default: STREAM_DURATION_BUCKETS)
         """
         self.prefix = prefix
+        self.max_endpoints = max_endpoints
+
+        # Normalized label value per endpoint seen so far, see _normalize_endpoint
+        self._endpoints: Dict[str, str] = {}
+
+        # Labeled children per normalized endpoint, see _endpoint_children
+        self._child_cache: Dict[str, StreamChildren] = {}
+
+        # Pending stream durations keyed by labeled duration histogram child
+        self._pending_durations = MetricBatch(_observe_durations, DURATION_FLUSH_INTERVAL)
         
         # Define Prometheus metrics with safe creation to avoid duplicates
-        self.active_streams = self._create_or_get_gauge(
+        self.active_streams = self._create_or_get(
+            Gauge,
             f'{prefix}_active_streams',
             'Number of active streaming responses',
             ['endpoint']
         )
         
-        self.stream_chunks_total = self._create_or_get_counter(
+        # Chunk and byte counts are updated for every stream flush, so they skip
+        # the locking of prometheus_client counters
+        self.stream_chunks_total = self._create_or_get(
+            _UnlockedCounter,
             f'{prefix}_stream_chunks_total',
             'Total number of chunks sent in streaming responses',
             ['endpoint']
         )
         
-        self.stream_bytes_total = self._create_or_get_counter(
+        self.stream_bytes_total = self._create_or_get(
+            _UnlockedCounter,
             f'{prefix}_stream_bytes_total',
             'Total bytes sent in streaming responses',
             ['endpoint']
         )
         
-        self.stream_duration_seconds = self._create_or_get_histogram(
+        self.stream_duration_seconds = self._create_or_get(
+            Histogram,
             f'{prefix}_stream_duration_seconds',
             'Duration of streaming responses in seconds',
             ['endpoint'],
-            buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+            buckets=buckets or STREAM_DURATION_BUCKETS
         )
         
-        self.stream_errors_total = self._create_or_get_counter(
+        self.stream_errors_total = self._create_or_get(
+            Counter,
             f'{prefix}_stream_errors_total',
             'Total number of errors in streaming responses',
             ['endpoint', 'error_type']
         )
     
-    def _create_or_get_counter(self, name: str, documentation: str, labelnames: Optional[List[str]] = None) -> Counter:
+    def _create_or_get(self, metric_class: type, name: str, documentation: str, labelnames: Optional[List[str]] = None, **kwargs: Any) -> Any:
         """
-        Create a new Counter or return an existing one with the same name.
+        Create a new metric or return an existing one with the same name.
         
         Args:
+            metric_class: The metric class (Counter, Histogram, Gauge or _UnlockedCounter)
             name: Metric name
             documentation: Metric documentation
             labelnames: List of label names
+            **kwargs: Additional arguments for the metric class, e.g. buckets
             
         Returns:
-            A Counter metric
-        """
-        try:
-            # Try to create a new Counter
-            return Counter(name, documentation, labelnames or [])
-        except ValueError:
-            # If it already exists, try to get it from the registry
-            for metric in REGISTRY._names_to_collectors.values():
-                if metric.name == name:
-                    return metric
-            # If we can't find it, create a new one with a different name
-            return Counter(f"{name}_new", documentation, labelnames or [])
-    
-    def _create_or_get_histogram(self, name: str, documentation: str, labelnames: Optional[List[str]] = None, buckets: Optional[tuple] = None) -> Histogram:
+            A metric of the given class
         """
-        Create a new Histogram or return an existing one with the same name.
-        
-        Args:
-            name: Metric name
-            documentation: Metric documentation
-            labelnames: List of label names
-            buckets: Histogram buckets
-            
-        Returns:
-            A Histogram metric
-        """
-        try:
-            # Try to create a new Histogram
-            return Histogram(name, documentation, labelnames or [], buckets=buckets)
-        except ValueError:
-            # If it already exists, try to get it from the registry
-            for metric in REGISTRY._names_to_collectors.values():
-                if metric.name == name:
-                    return metric
-            # If we can't find it, create a new one with a different name
-            return Histogram(f"{name}_new", documentation, labelnames or [], buckets=buckets)
+        # Reuse the metric if it is already registered, otherwise create it
+        metric = REGISTRY._names_to_collectors.get(name)
+        if metric is None:
+            metric = metric_class(name, documentation, labelnames or [], **kwargs)
+        return metric
     
-    def _create_or_get_gauge(self, name: str, documentation: str, labelnames: Optional[List[str]] = None) -> Gauge:
+    def _normalize_endpoint(self, endpoint: str) -> str:
         """
-        Create a new Gauge or return an existing one with the same name.
+        Map an endpoint to a bounded label value.
+        
+        Endpoints are truncated and stripped of unexpected characters. Once
+        max_endpoints distinct endpoints have been seen, new ones collapse into
+        "__overflow__" so dynamic endpoint names cannot grow the number of series
+        without bound.
         
         Args:
-            name: Metric name
-            documentation: Metric documentation
-            labelnames: List of label names
+            endpoint: The endpoint path or name
             
         Returns:
-            A Gauge metric
-        """
-        try:
-            # Try to create a new Gauge
-            return Gauge(name, documentation, labelnames or [])
-        except ValueError:
-            # If it already exists, try to get it from the registry
-            for metric in REGISTRY._names_to_collectors.values():
-                if metric.name == name:
-                    return metric
-            # If we can't find it, create a new one with a different name
-            return Gauge(f"{name}_new", documentation, labelnames or [])
+            The endpoint label value
+        """
+        normalized = self._endpoints.get(endpoint)
+        if normalized is None:
+            if len(self._endpoints) >= self.max_endpoints:
+                return OVERFLOW_ENDPOINT
+            normalized = _INVALID_ENDPOINT_CHARS.sub("_", str(endpoint)[:MAX_ENDPOINT_LENGTH])
+            self._endpoints[endpoint] = normalized
+        return normalized
     
-    def _safe_labels(self, metric: Any, labels_dict: Dict[str, str]) -> Any:
+    def _endpoint_children(self, endpoint: str) -> StreamChildren:
         """
-        Safely get a labeled metric, handling any exceptions.
+        Get the labeled metric children for an endpoint, binding them on first use.
         
         Args:
-            metric: The metric object
-            labels_dict: Dictionary of label names and values
+            endpoint: The endpoint path or name
             
         Returns:
-            The labeled metric or None if an error occurred
+            The active, chunks, bytes and duration children for the endpoint
         """
-        try:
-            return metric.labels(**labels_dict)
-        except Exception as e:
-            logger.warning(f"Error getting labels for metric: {e}")
-            return None
+        endpoint = self._normalize_endpoint(endpoint)
+        children = self._child_cache.get(endpoint)
+        if children is None:
+            children = StreamChildren(*(
+                metric.labels(endpoint)
+                for metric in (
+                    self.active_streams,
+                    self.stream_chunks_total,
+                    self.stream_bytes_total,
+                    self.stream_duration_seconds
+                )
+            ))
+            self._child_cache[endpoint] = children
+        return children
     
-    def track_stream_started(self, endpoint: str) -> None:
+    def track_stream_started(self, endpoint: str) -> StreamChildren:
         """
         Track the start of a streaming response.
         
         Args:
             endpoint: The endpoint path or name
+            
+        Returns:
+            The labeled metric children for the endpoint, so callers can update
+            them directly for every chunk
         """
-        try:
-            labeled_metric = self._safe_labels(self.active_streams, {"endpoint": endpoint})
-            if labeled_metric:
-                labeled_metric.inc()
-        except Exception as e:
-            logger.warning(f"Error tracking stream start: {e}")
+        children = self._endpoint_children(endpoint)
+        children.active.inc()
+        return children
     
     def track_stream_chunk(self, endpoint: str, chunk_size: int) -> None:
         """
@@ -174,18 +321,9 @@ class StreamingMetrics:
             endpoint: The endpoint path or name
             chunk_size: Size of the chunk in bytes
         """
-        try:
-            # Track chunk count
-            labeled_metric = self._safe_labels(self.stream_chunks_total, {"endpoint": endpoint})
-            if labeled_metric:
-                labeled_metric.inc()
-            
-            # Track bytes sent
-            labeled_metric = self._safe_labels(self.stream_bytes_total, {"endpoint": endpoint})
-            if labeled_metric:
-                labeled_metric.inc(chunk_size)
-        except Exception as e:
-            logger.warning(f"Error tracking stream chunk: {e}")
+        children = self._endpoint_children(endpoint)
+        children.chunks.inc()
+        children.bytes.inc(chunk_size)
     
     def track_stream_finished(self, endpoint: str, duration: float) -> None:
         """
@@ -195,18 +333,31 @@ class StreamingMetrics:
             endpoint: The endpoint path or name
             duration: Duration of the stream in seconds
         """
-        try:
-            # Decrement active streams
-            labeled_metric = self._safe_labels(self.active_streams, {"endpoint": endpoint})
-            if labeled_metric:
-                labeled_metric.dec()
-            
-            # Record duration
-            labeled_metric = self._safe_labels(self.stream_duration_seconds, {"endpoint": endpoint})
-            if labeled_metric:
-                labeled_metric.observe(duration)
-        except Exception as e:
-            logger.warning(f"Error tracking stream finish: {e}")
+        children = self._endpoint_children(endpoint)
+        children.active.dec()
+        self.observe_duration(children.duration, duration)
+    
+    def observe_duration(self, duration_child: Any, duration: float) -> None:
+        """
+        Batch a stream duration for the duration histogram.
+        
+        Durations are observed in batches by flush_durations, so streams ending
+        at the same time do not contend on the histogram lock.
+        
+        Args:
+            duration_child: The labeled duration histogram child of the endpoint
+            duration: Duration of the stream in seconds
+        """
+        self._pending_durations.add(duration_child, duration)
+    
+    def flush_durations(self) -> None:
+        """
+        Observe all batched stream durations.
+        
+        Durations are also flushed periodically while streams are finishing and
+        whenever the default registry is collected.
+        """
+        self._pending_durations.flush()
     
     def track_stream_error(self, endpoint: str, error_type: str) -> None:
         """
@@ -216,13 +367,5 @@ class StreamingMetrics:
             endpoint: The endpoint path or name
             error_type: Type of error that occurred
         """
-        try:
-            labeled_metric = self._safe_labels(self.stream_errors_total, {
-                "endpoint": endpoint,
-                "error_type": error_type
-            })
-            if labeled_metric:
-                labeled_metric.inc()
-        except Exception as e:
-            logger.warning(f"Error tracking stream error: {e}")
+        self.stream_errors_total.labels(self._normalize_endpoint(endpoint), error_type).inc()
 
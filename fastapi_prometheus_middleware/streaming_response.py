@@ -4,14 +4,17 @@ Utilities for creating FastAPI StreamingResponse objects with Prometheus metrics
 This module provides functions for creating streaming responses that automatically track metrics.
 """
 
-import inspect
 import logging
-from typing import AsyncGenerator, Any, Optional, Dict, Union
+from typing import AsyncGenerator, Any, Optional, Dict
 
 from fastapi import Response
 from starlette.responses import StreamingResponse
 
-from fastapi_prometheus_middleware.streaming_wrapper import StreamingMetricsWrapper
+from fastapi_prometheus_middleware.streaming_wrapper import (
+    track_streaming_generator,
+    streaming_metrics_decorator,
+    _as_endpoint
+)
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -23,7 +26,8 @@ def create_streaming_response(
     status_code: int = 200,
     headers: Optional[Dict[str, str]] = None,
     background: Optional[Any] = None,
-    endpoint: Optional[str] = None
+    endpoint: Optional[str] = None,
+    strict_bytes: bool = False
 ) -> StreamingResponse:
     """
     Create a StreamingResponse with Prometheus metrics tracking.
@@ -36,33 +40,15 @@ def create_streaming_response(
         status_code: The HTTP status code (default: 200)
         headers: Additional headers to include in the response
         background: Background tasks to run after the response is sent
-        endpoint: The endpoint path or name (default: auto-detected)
+        endpoint: The endpoint path or name (default: "unknown")
+        strict_bytes: Require the generator to produce bytes, raising TypeError
+            on a chunk of any other type (default: False)
 
     Returns:
         A StreamingResponse object with metrics tracking
     """
-    # Determine the endpoint name if not provided
-    if endpoint is None:
-        try:
-            # Get the caller's frame
-            frame = inspect.currentframe().f_back
-            if frame:
-                # Try to get the function name
-                func_name = frame.f_code.co_name
-                # Try to get the class name if it's a method
-                if 'self' in frame.f_locals:
-                    class_name = frame.f_locals['self'].__class__.__name__
-                    endpoint = f"{class_name}.{func_name}"
-                else:
-                    endpoint = func_name
-            else:
-                endpoint = "unknown"
-        except Exception as e:
-            logger.warning(f"Error getting caller endpoint: {e}")
-            endpoint = "unknown"
-
     # Wrap the generator with metrics tracking
-    metrics_generator = StreamingMetricsWrapper(generator, endpoint)
+    metrics_generator = track_streaming_generator(generator, endpoint or "unknown", strict_bytes)
 
     # Create and return the StreamingResponse
     return StreamingResponse(
@@ -78,43 +64,41 @@ def streaming_response_decorator(
     media_type: str = "text/event-stream",
     status_code: int = 200,
     headers: Optional[Dict[str, str]] = None,
-    endpoint: Optional[str] = None
+    endpoint: Optional[str] = None,
+    strict_bytes: bool = False
 ):
     """
     Decorator for creating endpoint functions that return StreamingResponse with metrics tracking.
 
+    The decorated function should produce an AsyncGenerator[bytes, None]; str chunks
+    are accepted but their size is counted in characters rather than bytes, unless
+    strict_bytes is set.
+
     Args:
         media_type: The media type of the response (default: "text/event-stream")
         status_code: The HTTP status code (default: 200)
         headers: Additional headers to include in the response
-        endpoint: The endpoint path or name (default: auto-detected)
+        endpoint: The endpoint path or name (default: the function's qualified name)
+        strict_bytes: Require the generator to produce bytes, raising TypeError
+            on a chunk of any other type (default: False)
 
     Returns:
         A decorator function
     """
     def decorator(func):
-        async def wrapper(*args, **kwargs):
-            # Get the generator from the original function
-            generator = await func(*args, **kwargs)
-
-            # Determine the endpoint name
-            endpoint_name = endpoint
-            if endpoint_name is None:
-                if hasattr(func, "__qualname__"):
-                    endpoint_name = func.__qualname__
-                else:
-                    endpoint_name = func.__name__
+        # Wrap the endpoint's generator with metrics tracking
+        tracked_func = streaming_metrics_decorator(endpoint, strict_bytes)(func)
 
+        async def wrapper(*args, **kwargs):
             # Create and return the StreamingResponse
-            return create_streaming_response(
-                generator,
+            return StreamingResponse(
+                await tracked_func(*args, **kwargs),
                 media_type=media_type,
                 status_code=status_code,
-                headers=headers,
-                endpoint=endpoint_name
+                headers=headers
             )
 
-        return wrapper
+        return _as_endpoint(wrapper, func)
 
     return decorator
 
@@ -124,7 +108,8 @@ def create_metrics_streaming_response(
     media_type: str = "text/event-stream",
     status_code: int = 200,
     headers: Optional[Dict[str, str]] = None,
-    endpoint: Optional[str] = None
+    endpoint: Optional[str] = None,
+    strict_bytes: bool = False
 ) -> StreamingResponse:
     """
     Create a StreamingResponse with Prometheus metrics tracking.
@@ -136,7 +121,9 @@ def create_metrics_streaming_response(
         media_type: The media type of the response (default: "text/event-stream")
         status_code: The HTTP status code (default: 200)
         headers: Additional headers to include in the response
-        endpoint: The endpoint path or name (default: auto-detected)
+        endpoint: The endpoint path or name (default: "unknown")
+        strict_bytes: Require the generator to produce bytes, raising TypeError
+            on a chunk of any other type (default: False)
 
     Returns:
         A StreamingResponse with metrics tracking
@@ -146,5 +133,6 @@ def create_metrics_streaming_response(
         media_type=media_type,
         status_code=status_code,
         headers=headers,
-        endpoint=endpoint
+        endpoint=endpoint,
+        strict_bytes=strict_bytes
     )
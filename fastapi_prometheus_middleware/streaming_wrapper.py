@@ -4,17 +4,119 @@ Wrapper for streaming responses to track Prometheus metrics.
 This module provides utilities for wrapping streaming generators with metrics tracking.
 """
 
-import time
 import inspect
 import logging
-from typing import AsyncGenerator, Any, Optional, Callable, Union
+import os
+import time
+from typing import AsyncGenerator, Any, Optional, Callable
 
-from fastapi_prometheus_middleware.streaming_metrics import StreamingMetrics
-from fastapi_prometheus_middleware.metrics_registry import get_metrics
+from fastapi_prometheus_middleware.streaming_metrics import StreamingMetrics, StreamChildren
+from fastapi_prometheus_middleware.metrics_registry import get_metrics, _add_reset_hook
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+# Set FASTAPI_PROM_STREAM_DISABLED=1 to serve streaming generators without metrics tracking
+STREAM_METRICS_DISABLED = os.environ.get("FASTAPI_PROM_STREAM_DISABLED") == "1"
+
+# Chunk and byte counts are buffered per stream and flushed to the counters after
+# this many chunks or this many nanoseconds, whichever comes first
+STREAM_FLUSH_CHUNKS = 32
+STREAM_FLUSH_INTERVAL_NS = 50_000_000
+
+# Chunk types whose size is measured with len(); other chunks count as one byte
+_SIZED_CHUNK_TYPES = (bytes, bytearray, memoryview, str)
+
+# Chunk types accepted when a stream is tracked with strict_bytes
+_BYTES_CHUNK_TYPES = (bytes, bytearray, memoryview)
+
+
+def _unit_size(chunk: Any) -> int:
+    """
+    Size function for chunks that have no length.
+
+    Args:
+        chunk: A chunk from a streaming generator
+
+    Returns:
+        Always 1
+    """
+    return 1
+
+
+def _bytes_size(chunk: Any) -> int:
+    """
+    Size function for streams tracked with strict_bytes.
+
+    Args:
+        chunk: A chunk from a streaming generator
+
+    Returns:
+        The length of the chunk in bytes
+
+    Raises:
+        TypeError: If the chunk is not bytes
+    """
+    if not isinstance(chunk, _BYTES_CHUNK_TYPES):
+        raise TypeError(
+            f"Streaming response chunks must be bytes when strict_bytes is set, got {type(chunk).__name__}"
+        )
+    return len(chunk)
+
+
+def _chunk_sizer(chunk: Any, strict_bytes: bool = False) -> Callable[[Any], int]:
+    """
+    Pick the size function for a stream from its first chunk.
+
+    Args:
+        chunk: The first chunk from a streaming generator
+        strict_bytes: Whether the stream must produce bytes chunks (default: False)
+
+    Returns:
+        A function that checks every chunk is bytes if strict_bytes is set, len for
+        sized chunk types, otherwise a function that counts each chunk as one byte
+    """
+    if strict_bytes:
+        return _bytes_size
+    return len if isinstance(chunk, _SIZED_CHUNK_TYPES) else _unit_size
+
+
+# Cached streaming metrics instance, resolved from the registry on first use
+_streaming_metrics: Optional[StreamingMetrics] = None
+
+
+def _reset() -> None:
+    """
+    Clear the cached streaming metrics instance.
+
+    Called whenever a metrics instance is registered in the metrics registry.
+    """
+    global _streaming_metrics
+    _streaming_metrics = None
+
+
+_add_reset_hook(_reset)
+
+
+def _get_streaming_metrics() -> StreamingMetrics:
+    """
+    Get the streaming metrics instance, resolving it from the registry on first use.
+
+    Returns:
+        The registered StreamingMetrics instance, or a default instance if none is registered
+    """
+    global _streaming_metrics
+
+    metrics = _streaming_metrics
+    if metrics is None:
+        metrics = get_metrics('streaming_metrics')
+        if not metrics:
+            # Fallback to a new instance if not found in registry
+            metrics = StreamingMetrics()
+            logger.warning("No streaming metrics found in registry, using default instance")
+        _streaming_metrics = metrics
+    return metrics
+
 
 class StreamingMetricsWrapper:
     """
@@ -27,160 +129,205 @@ class StreamingMetricsWrapper:
     - Errors
     """
 
-    def __init__(self, generator, endpoint: Optional[str] = None):
+    __slots__ = ("generator", "endpoint", "strict_bytes", "start_time", "metrics", "children")
+
+    def __init__(self, generator, endpoint: str = "unknown", strict_bytes: bool = False):
         """
         Initialize the wrapper with a generator and endpoint.
 
         Args:
             generator: The async generator to wrap
-            endpoint: The endpoint path or name (default: auto-detected)
+            endpoint: The endpoint path or name (default: "unknown")
+            strict_bytes: Require the generator to produce bytes, raising TypeError
+                on a chunk of any other type (default: False)
         """
         self.generator = generator
-        self.endpoint = endpoint or self._get_caller_endpoint()
-        self.start_time = time.time()
+        self.endpoint = endpoint or "unknown"
+        self.strict_bytes = strict_bytes
+        self.start_time = time.monotonic_ns()
 
-        # Get the streaming metrics instance from the registry
-        self.metrics = get_metrics('streaming_metrics')
-        if not self.metrics:
-            # Fallback to a new instance if not found in registry
-            self.metrics = StreamingMetrics()
-            logger.warning("No streaming metrics found in registry, using default instance")
+        # Get the streaming metrics instance
+        self.metrics = _streaming_metrics or _get_streaming_metrics()
 
-        # Track stream start
-        self.metrics.track_stream_started(self.endpoint)
+        # Track stream start, keeping the endpoint's children for the per-chunk updates
+        self.children = self.metrics.track_stream_started(self.endpoint)
 
-    def _get_caller_endpoint(self) -> str:
+    def __aiter__(self) -> AsyncGenerator[Any, None]:
         """
-        Get the endpoint name from the caller's stack frame.
+        Iterate through the wrapped generator, tracking metrics for each chunk.
 
         Returns:
-            The endpoint name or 'unknown' if it can't be determined
+            An async generator over the chunks of the wrapped generator
         """
-        try:
-            # Get the caller's frame (2 levels up)
-            frame = inspect.currentframe().f_back.f_back
-            if frame:
-                # Try to get the function name
-                func_name = frame.f_code.co_name
-                # Try to get the class name if it's a method
-                if 'self' in frame.f_locals:
-                    class_name = frame.f_locals['self'].__class__.__name__
-                    return f"{class_name}.{func_name}"
-                return func_name
-            return "unknown"
-        except Exception as e:
-            logger.warning(f"Error getting caller endpoint: {e}")
-            return "unknown"
-
-    async def __aiter__(self):
-        """
-        Iterate through the wrapped generator, tracking metrics for each chunk.
+        return _track_stream(
+            self.generator,
+            self.endpoint,
+            self.strict_bytes,
+            self.metrics,
+            self.children,
+            self.start_time
+        )
 
-        Yields:
-            The chunks from the wrapped generator
-        """
-        try:
-            async for chunk in self.generator:
-                # Track the chunk
-                chunk_size = len(chunk) if isinstance(chunk, (str, bytes)) else 1
-                self.metrics.track_stream_chunk(self.endpoint, chunk_size)
-
-                # Yield the chunk
-                yield chunk
-        except Exception as e:
-            # Track the error
-            error_type = type(e).__name__
-            self.metrics.track_stream_error(self.endpoint, error_type)
-
-            # Re-raise the exception
-            logger.error(f"Error in streaming response: {e}")
-            raise
-        finally:
-            # Track stream end
-            duration = time.time() - self.start_time
-            self.metrics.track_stream_finished(self.endpoint, duration)
-
-
-def wrap_streaming_response(generator, endpoint: Optional[str] = None) -> AsyncGenerator:
+
+def wrap_streaming_response(generator, endpoint: str = "unknown", strict_bytes: bool = False) -> AsyncGenerator:
     """
     Wrap a streaming generator with metrics tracking.
 
-    This is a convenience function for creating a StreamingMetricsWrapper.
-
     Args:
         generator: The async generator to wrap
-        endpoint: The endpoint path or name (default: auto-detected)
+        endpoint: The endpoint path or name (default: "unknown")
+        strict_bytes: Require the generator to produce bytes, raising TypeError
+            on a chunk of any other type (default: False)
 
     Returns:
-        The wrapped generator
+        The wrapped generator, or the generator itself if streaming metrics are disabled
     """
-    return StreamingMetricsWrapper(generator, endpoint)
+    if STREAM_METRICS_DISABLED:
+        return generator
+    return track_streaming_generator(generator, endpoint or "unknown", strict_bytes)
 
 
-def streaming_metrics_decorator(endpoint: Optional[str] = None):
+def streaming_metrics_decorator(endpoint: Optional[str] = None, strict_bytes: bool = False):
     """
     Decorator for wrapping streaming generator functions with metrics tracking.
 
     Args:
-        endpoint: The endpoint path or name (default: auto-detected)
+        endpoint: The endpoint path or name (default: the function's qualified name)
+        strict_bytes: Require the generator to produce bytes, raising TypeError
+            on a chunk of any other type (default: False)
 
     Returns:
         A decorator function
     """
     def decorator(func):
+        # Resolve the endpoint name and generator type once, at decoration time
+        endpoint_name = endpoint or getattr(func, "__qualname__", func.__name__)
+        is_async_gen = inspect.isasyncgenfunction(func)
+
         async def wrapper(*args, **kwargs):
             # Get the generator from the original function
-            generator = await func(*args, **kwargs)
-
-            # Determine the endpoint name
-            endpoint_name = endpoint
-            if endpoint_name is None:
-                if hasattr(func, "__qualname__"):
-                    endpoint_name = func.__qualname__
-                else:
-                    endpoint_name = func.__name__
+            if is_async_gen:
+                generator = func(*args, **kwargs)
+            else:
+                generator = await func(*args, **kwargs)
 
             # Wrap the generator with metrics
-            return StreamingMetricsWrapper(generator, endpoint_name)
+            if STREAM_METRICS_DISABLED:
+                return generator
+            return track_streaming_generator(generator, endpoint_name, strict_bytes)
 
-        return wrapper
+        return _as_endpoint(wrapper, func)
 
     return decorator
 
 
-async def track_streaming_generator(
+def _as_endpoint(wrapper: Callable, func: Callable) -> Callable:
+    """
+    Give a decorator's wrapper the name and parameters of the decorated endpoint.
+
+    functools.wraps is not used since FastAPI would then see the decorated
+    async generator function and treat the wrapper as a generator endpoint.
+
+    Args:
+        wrapper: The wrapper function returned by the decorator
+        func: The decorated endpoint function
+
+    Returns:
+        The wrapper
+    """
+    wrapper.__name__ = func.__name__
+    wrapper.__qualname__ = func.__qualname__
+    wrapper.__signature__ = inspect.signature(func).replace(return_annotation=inspect.Signature.empty)
+    return wrapper
+
+
+def track_streaming_generator(
     generator: AsyncGenerator[Any, None],
-    endpoint: str
+    endpoint: str,
+    strict_bytes: bool = False
 ) -> AsyncGenerator[Any, None]:
     """
     Wrap a streaming generator with Prometheus metrics tracking.
 
-    This is a simpler alternative to StreamingMetricsWrapper when you just need
-    to wrap a generator directly without using a class.
+    This is a lighter alternative to StreamingMetricsWrapper: a single async
+    generator with no wrapper object. Tracking starts when the response begins
+    iterating it, so a response that is never sent leaves no active stream behind.
 
     Args:
         generator: The async generator to wrap
         endpoint: The endpoint path or name
+        strict_bytes: Require the generator to produce bytes, raising TypeError
+            on a chunk of any other type (default: False)
+
+    Returns:
+        The wrapped generator, or the generator itself if streaming metrics are disabled
+    """
+    if STREAM_METRICS_DISABLED:
+        return generator
+    return _track_stream(generator, endpoint, strict_bytes)
+
+
+async def _track_stream(
+    generator: AsyncGenerator[Any, None],
+    endpoint: str,
+    strict_bytes: bool = False,
+    metrics: Optional[StreamingMetrics] = None,
+    children: Optional[StreamChildren] = None,
+    start_time: int = 0
+) -> AsyncGenerator[Any, None]:
+    """
+    Iterate a streaming generator, tracking its chunks, errors and duration.
+
+    Chunk and byte counts are buffered and flushed to the counters every
+    STREAM_FLUSH_CHUNKS chunks or STREAM_FLUSH_INTERVAL_NS nanoseconds.
+
+    Args:
+        generator: The async generator to wrap
+        endpoint: The endpoint path or name
+        strict_bytes: Require the generator to produce bytes (default: False)
+        metrics: The streaming metrics, if the caller already started the stream
+        children: The endpoint's metric children, if the caller already started the stream
+        start_time: The monotonic_ns start time, if the caller already started the stream
 
     Yields:
         The chunks from the wrapped generator
     """
-    # Get the streaming metrics instance from the registry
-    metrics = get_metrics('streaming_metrics')
-    if not metrics:
-        # Fallback to a new instance if not found in registry
-        metrics = StreamingMetrics()
-        logger.warning("No streaming metrics found in registry, using default instance")
-
-    # Track stream start
-    metrics.track_stream_started(endpoint)
-    start_time = time.time()
+    monotonic_ns = time.monotonic_ns
+
+    # Track stream start, unless the caller already did
+    if children is None:
+        metrics = _streaming_metrics or _get_streaming_metrics()
+        children = metrics.track_stream_started(endpoint)
+        start_time = monotonic_ns()
+
+    # Bind everything the loop touches to locals once per stream
+    chunks_child = children.chunks
+    bytes_child = children.bytes
+    flush_chunks = STREAM_FLUSH_CHUNKS
+    flush_interval_ns = STREAM_FLUSH_INTERVAL_NS
+    last_flush = monotonic_ns()
+    pending_chunks = 0
+    pending_bytes = 0
+    sizer = None
 
     try:
         async for chunk in generator:
-            # Track the chunk
-            chunk_size = len(chunk) if isinstance(chunk, (str, bytes)) else 1
-            metrics.track_stream_chunk(endpoint, chunk_size)
+            # Track the chunk, flushing the buffered counts periodically
+            if sizer is None:
+                sizer = _chunk_sizer(chunk, strict_bytes)
+            pending_chunks += 1
+            try:
+                pending_bytes += sizer(chunk)
+            except TypeError:
+                if strict_bytes:
+                    raise
+                pending_bytes += 1
+            now = monotonic_ns()
+            if pending_chunks >= flush_chunks or now - last_flush >= flush_interval_ns:
+                chunks_child.inc(pending_chunks)
+                bytes_child.inc(pending_bytes)
+                pending_chunks = pending_bytes = 0
+                last_flush = now
 
             # Yield the chunk
             yield chunk
@@ -192,6 +339,12 @@ async def track_streaming_generator(
         # Re-raise the exception
         raise
     finally:
+        # Flush the remaining chunk counts
+        if pending_chunks:
+            chunks_child.inc(pending_chunks)
+            bytes_child.inc(pending_bytes)
+
         # Track stream end
-        duration = time.time() - start_time
-        metrics.track_stream_finished(endpoint, duration)
+        duration = (monotonic_ns() - start_time) / 1e9
+        children.active.dec()
+        metrics.observe_duration(children.duration, duration)
@@ -26,9 +26,11 @@ setup(
     python_requires=">=3.10",
     install_requires=[
         "fastapi>=0.115.3",
-        "prometheus-client>=0.3.0",
+        "prometheus-client>=0.17",
         "starlette>=0.41.3",
-        "orjson>=3.9.15",
         "pydantic>=1.10.12"
     ],
+    extras_require={
+        "fast-json": ["orjson>=3.9.15"],
+    },
 )
@@ -0,0 +1,48 @@
+"""
+Shared fixtures for the FastAPI Prometheus Middleware tests.
+"""
+
+import pytest
+from fastapi import FastAPI
+from httpx import ASGITransport, AsyncClient
+
+try:
+    import uvloop  # noqa: F401
+    _USE_UVLOOP = True
+except ImportError:
+    _USE_UVLOOP = False
+
+from fastapi_prometheus_middleware import PrometheusMiddleware, metrics, metrics_endpoint
+
+
+@pytest.fixture(autouse=True)
+def no_metrics_cache(monkeypatch):
+    """Render /metrics on every scrape so tests see fresh values."""
+    monkeypatch.setattr(metrics, "METRICS_CACHE_TTL", 0)
+
+
+@pytest.fixture
+def anyio_backend():
+    """Run async tests on asyncio, using uvloop when it is installed."""
+    return ("asyncio", {"use_uvloop": _USE_UVLOOP})
+
+
+@pytest.fixture(scope="session")
+def base_app():
+    """Create the FastAPI app with the Prometheus middleware shared by all test modules.
+
+    Test modules add their own routes to it through a module-scoped ``app`` fixture.
+    """
+    app = FastAPI()
+    app.add_middleware(PrometheusMiddleware, prefix="test")
+    app.add_route('/metrics', metrics_endpoint)
+    return app
+
+
+@pytest.fixture
+async def client(app):
+    """Create an in-process async client for the module's app."""
+    # Unhandled endpoint errors are returned as 500 responses instead of raised
+    transport = ASGITransport(app=app, raise_app_exceptions=False)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        yield client
@@ -0,0 +1,116 @@
+"""
+Tests for the exception tracking utilities of the FastAPI Prometheus Middleware.
+"""
+
+import asyncio
+import threading
+
+import pytest
+from prometheus_client import REGISTRY
+
+from fastapi_prometheus_middleware import APIMetrics, get_metrics, register_metrics, track_detailed_exception
+from fastapi_prometheus_middleware import exception_tracker, metrics_registry
+from fastapi_prometheus_middleware.exception_tracker import flush_exception_counts
+
+metrics = APIMetrics(prefix="tracker_test")
+
+
+@pytest.fixture(autouse=True)
+def tracker_metrics():
+    """Register the tracker test metrics for one test and restore the previous ones."""
+    previous = get_metrics('api_metrics')
+    register_metrics('api_metrics', metrics)
+    yield metrics
+
+    # Apply counts batched by the test before the previous metrics come back
+    flush_exception_counts()
+    if previous is not None:
+        register_metrics('api_metrics', previous)
+    else:
+        metrics_registry._metrics_registry.pop('api_metrics', None)
+        exception_tracker._reset()
+
+
+def _exception_count(exception_type: str, code: str) -> float:
+    # Collecting the registry flushes batched counts, like a scrape
+    return REGISTRY.get_sample_value(
+        "tracker_test_exceptions_total",
+        {"exception_type": exception_type, "module": __name__, "code": code}
+    ) or 0.0
+
+
+def _applied_count(exception_type: str, code: str) -> float:
+    # Collecting the counter alone does not flush batched counts
+    labels = {"exception_type": exception_type, "module": __name__, "code": code}
+    for family in metrics.exception_counter.collect():
+        for sample in family.samples:
+            if sample.name == "tracker_test_exceptions_total" and sample.labels == labels:
+                return sample.value
+    return 0.0
+
+
+def _raise_and_track(status_code: int) -> None:
+    try:
+        raise KeyError("missing")
+    except KeyError as e:
+        track_detailed_exception(e, status_code)
+
+
+def test_detailed_exception_outside_event_loop():
+    """Test that exceptions tracked outside an event loop are counted by the next scrape."""
+    before = _exception_count("KeyError", "404")
+
+    _raise_and_track(404)
+
+    assert _exception_count("KeyError", "404") == before + 1
+
+
+def test_detailed_exception_batched_in_event_loop():
+    """Test that exceptions tracked in an event loop are batched until flushed."""
+    before = _applied_count("KeyError", "409")
+
+    async def track_many():
+        for _ in range(3):
+            _raise_and_track(409)
+        return _applied_count("KeyError", "409")
+
+    assert asyncio.run(track_many()) == before
+
+    flush_exception_counts()
+    assert _applied_count("KeyError", "409") == before + 3
+
+
+def test_flush_scheduled_after_loop_closed(monkeypatch):
+    """Test that a flush left pending on a closed loop does not block later flushes."""
+    batch = exception_tracker._exception_batch
+    before = _applied_count("KeyError", "410")
+
+    async def track(wait: float):
+        _raise_and_track(410)
+        await asyncio.sleep(wait)
+
+    # The first loop closes before its scheduled flush runs
+    monkeypatch.setattr(batch, "interval", 60)
+    asyncio.run(track(0))
+
+    monkeypatch.setattr(batch, "interval", 0)
+    asyncio.run(track(0.01))
+    assert _applied_count("KeyError", "410") == before + 2
+
+
+def test_detailed_exception_from_threads():
+    """Test that no exception counts are lost when threads track and flush concurrently."""
+    before = _exception_count("KeyError", "411")
+
+    def track_many():
+        for _ in range(200):
+            _raise_and_track(411)
+            flush_exception_counts()
+
+    threads = [threading.Thread(target=track_many) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert _exception_count("KeyError", "411") == before + 800
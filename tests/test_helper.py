@@ -0,0 +1,38 @@
+"""
+Tests for the helper functions of the FastAPI Prometheus Middleware.
+"""
+
+import asyncio
+import os
+
+from fastapi_prometheus_middleware import generate_prometheus_data
+
+
+def test_generate_prometheus_data_writes_file(tmp_path):
+    """Test that metrics data is written to the given file."""
+    file_path = tmp_path / "metrics.prom"
+    asyncio.run(generate_prometheus_data(str(file_path)))
+
+    assert file_path.exists()
+    assert "python_info" in file_path.read_text()
+    # No temporary files should be left behind
+    assert [p.name for p in tmp_path.iterdir()] == ["metrics.prom"]
+
+
+def test_generate_prometheus_data_file_mode(tmp_path):
+    """Test that the metrics file gets the default permissions for the umask."""
+    umask = os.umask(0)
+    os.umask(umask)
+
+    file_path = tmp_path / "metrics.prom"
+    asyncio.run(generate_prometheus_data(str(file_path)))
+
+    assert file_path.stat().st_mode & 0o777 == 0o666 & ~umask
+
+
+def test_generate_prometheus_data_returns_bytes():
+    """Test that metrics data is returned as bytes when no file is given."""
+    data = asyncio.run(generate_prometheus_data())
+
+    assert isinstance(data, bytes)
+    assert b"python_info" in data
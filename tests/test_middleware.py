@@ -2,19 +2,29 @@
 Tests for the FastAPI Prometheus Middleware.
 """
 
+import asyncio
+
 import pytest
-from fastapi import FastAPI
-from fastapi.testclient import TestClient
-from fastapi_prometheus_middleware import PrometheusMiddleware, metrics_endpoint
+from fastapi import Request, Response
+from prometheus_client import REGISTRY
+from fastapi_prometheus_middleware import APIMetrics, set_token_usage
+from fastapi_prometheus_middleware import metrics
 
+pytestmark = pytest.mark.anyio
+
+
+def _metric_families(metrics_text):
+    """Return the names of the metric families in a /metrics payload."""
+    return frozenset(
+        line.split(" ", 3)[2] for line in metrics_text.splitlines() if line.startswith("# TYPE ")
+    )
+
+
+@pytest.fixture(scope="module")
+def app(base_app):
+    """Add the middleware test routes to the shared app."""
+    app = base_app
 
-@pytest.fixture
-def app():
-    """Create a FastAPI app with the Prometheus middleware."""
-    app = FastAPI()
-    app.add_middleware(PrometheusMiddleware, prefix="test")
-    app.add_route('/metrics', metrics_endpoint)
-    
     @app.get("/")
     async def root():
         return {"message": "Hello World"}
@@ -23,6 +33,19 @@ def app():
     async def read_item(item_id: int):
         return {"item_id": item_id}
     
+    @app.get("/tokens")
+    async def tokens():
+        set_token_usage(input_tokens=3, output_tokens=4)
+        return {"message": "tokens"}
+
+    @app.get("/user")
+    async def user(request: Request):
+        return {"user_id": request.state.user_data.userId}
+
+    @app.get("/slow")
+    async def slow():
+        await asyncio.sleep(3600)
+
     @app.get("/error")
     async def error():
         raise ValueError("Test error")
@@ -30,53 +53,100 @@ def app():
     return app
 
 
-@pytest.fixture
-def client(app):
-    """Create a test client for the FastAPI app."""
-    return TestClient(app)
-
-
-def test_root_endpoint(client):
+async def test_root_endpoint(client):
     """Test that the root endpoint works."""
-    response = client.get("/")
+    response = await client.get("/")
     assert response.status_code == 200
     assert response.json() == {"message": "Hello World"}
 
 
-def test_items_endpoint(client):
+async def test_items_endpoint(client):
     """Test that the items endpoint works."""
-    response = client.get("/items/1")
+    response = await client.get("/items/1")
     assert response.status_code == 200
     assert response.json() == {"item_id": 1}
 
 
-def test_metrics_endpoint(client):
+async def test_metrics_endpoint(client):
     """Test that the metrics endpoint works."""
     # Make some requests to generate metrics
-    client.get("/")
-    client.get("/items/1")
+    await client.get("/")
+    await client.get("/items/1")
     
     # Get the metrics
-    response = client.get("/metrics")
+    response = await client.get("/metrics")
     assert response.status_code == 200
     
     # Check that the metrics contain the expected data
-    metrics_text = response.text
-    assert "test_http_requests_total" in metrics_text
-    assert "test_http_request_duration_seconds" in metrics_text
+    expected = {"test_http_requests_total", "test_http_request_duration_seconds"}
+    assert expected <= _metric_families(response.text)
+
 
+async def test_metrics_endpoint_cache(client, monkeypatch):
+    """Test that scrapes within the cache TTL reuse the rendered payload."""
+    monkeypatch.setattr(metrics, "METRICS_CACHE_TTL", 60)
+    first = (await client.get("/metrics")).text
 
-def test_error_tracking(client):
+    await client.get("/")
+    assert (await client.get("/metrics")).text == first
+
+
+async def test_error_tracking(client):
     """Test that errors are tracked."""
     # Make a request that will cause an error
-    response = client.get("/error", expect_errors=True)
+    response = await client.get("/error")
     assert response.status_code == 500
     
     # Get the metrics
-    response = client.get("/metrics")
+    response = await client.get("/metrics")
     assert response.status_code == 200
     
     # Check that the error metrics contain the expected data
-    metrics_text = response.text
-    assert "test_errors_total" in metrics_text
-    assert "test_exceptions_total" in metrics_text
+    expected = {"test_errors_total", "test_exceptions_total"}
+    assert expected <= _metric_families(response.text)
+
+
+async def test_token_usage_tracking(client):
+    """Test that token usage set in an endpoint is tracked."""
+    before = REGISTRY.get_sample_value("test_token_usage_total", {"type": "total"}) or 0
+
+    response = await client.get("/tokens")
+    assert response.status_code == 200
+
+    after = REGISTRY.get_sample_value("test_token_usage_total", {"type": "total"})
+    assert after == before + 7
+
+
+async def test_user_data_header(client):
+    """Test that the x-user-data header is exposed as request.state.user_data."""
+    response = await client.get("/user", headers={"x-user-data": '{"_id": 5, "workspace": []}'})
+    assert response.status_code == 200
+    assert response.json() == {"user_id": 5}
+
+
+async def test_cancelled_request_not_left_active(client):
+    """Test that a cancelled request is removed from the active requests gauge."""
+    labels = {"method": "GET", "endpoint": "/slow"}
+    before = REGISTRY.get_sample_value("test_active_requests", labels) or 0
+
+    task = asyncio.ensure_future(client.get("/slow"))
+    while (REGISTRY.get_sample_value("test_active_requests", labels) or 0) == before:
+        await asyncio.sleep(0)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert REGISTRY.get_sample_value("test_active_requests", labels) == before
+
+
+def test_track_request_completed_accepts_response():
+    """Test that track_request_completed accepts a response object or a status code."""
+    api_metrics = APIMetrics(prefix="test")
+    request = Request({"type": "http", "method": "GET", "path": "/manual", "headers": []})
+    labels = {"method": "GET", "endpoint": "/manual", "status_code": "201"}
+    before = REGISTRY.get_sample_value("test_http_requests_total", labels) or 0
+
+    api_metrics.track_request_completed(request, Response(b"created", status_code=201), 0.1)
+    api_metrics.track_request_completed(request, 201, 0.1)
+
+    assert REGISTRY.get_sample_value("test_http_requests_total", labels) == before + 2
@@ -4,29 +4,32 @@ Tests for the streaming response functionality of the FastAPI Prometheus Middlew
 
 import pytest
 import asyncio
-from fastapi import FastAPI
-from fastapi.testclient import TestClient
 from fastapi.responses import StreamingResponse
+from prometheus_client import REGISTRY
 from fastapi_prometheus_middleware import (
-    PrometheusMiddleware, 
-    metrics_endpoint,
     wrap_streaming_response,
-    streaming_response_decorator
+    streaming_response_decorator,
+    track_streaming_generator,
+    StreamingMetrics,
+    get_metrics,
+    register_metrics
 )
+from fastapi_prometheus_middleware import metrics_registry, streaming_wrapper
 
+# Precomputed SSE chunks yielded by the streaming endpoints
+_CHUNKS = tuple(f"data: {i}\n\n".encode() for i in range(3))
+
+
+@pytest.fixture(scope="module")
+def app(base_app):
+    """Add the streaming test routes to the shared app."""
+    app = base_app
 
-@pytest.fixture
-def app():
-    """Create a FastAPI app with the Prometheus middleware."""
-    app = FastAPI()
-    app.add_middleware(PrometheusMiddleware, prefix="test")
-    app.add_route('/metrics', metrics_endpoint)
-    
     @app.get("/stream")
     async def stream_data():
         async def generator():
-            for i in range(3):
-                yield f"data: {i}\n\n"
+            for chunk in _CHUNKS:
+                yield chunk
         
         # Wrap the generator with metrics tracking
         tracked_generator = wrap_streaming_response(generator(), endpoint="/stream")
@@ -36,45 +39,210 @@ def app():
     @app.get("/stream2")
     @streaming_response_decorator(media_type="text/event-stream")
     async def stream_data2():
-        for i in range(3):
-            yield f"data: {i}\n\n"
+        for chunk in _CHUNKS:
+            yield chunk
     
     return app
 
 
 @pytest.fixture
-def client(app):
-    """Create a test client for the FastAPI app."""
-    return TestClient(app)
+def wrapper_metrics():
+    """Register dedicated streaming metrics for one test and restore the previous ones."""
+    previous = get_metrics('streaming_metrics')
+    metrics = StreamingMetrics(prefix="wrapper_test")
+    register_metrics('streaming_metrics', metrics)
+    yield metrics
+    if previous is not None:
+        register_metrics('streaming_metrics', previous)
+    else:
+        metrics_registry._metrics_registry.pop('streaming_metrics', None)
+        streaming_wrapper._reset()
 
 
-def test_wrapped_streaming_response(client):
+async def _generate(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+@pytest.mark.anyio
+async def test_wrapped_streaming_response(client):
     """Test that wrapped streaming responses work."""
-    response = client.get("/stream")
-    assert response.status_code == 200
-    assert response.headers["content-type"] == "text/event-stream"
+    labels = {"endpoint": "/stream"}
+    chunks_before = REGISTRY.get_sample_value("test_stream_chunks_total", labels) or 0
+    bytes_before = REGISTRY.get_sample_value("test_stream_bytes_total", labels) or 0
+
+    async with client.stream("GET", "/stream") as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        body = b"".join([chunk async for chunk in response.aiter_bytes()])
+    assert body == b"".join(_CHUNKS)
     
     # Get the metrics
-    metrics_response = client.get("/metrics")
+    metrics_response = await client.get("/metrics")
     assert metrics_response.status_code == 200
     
     # Check that the streaming metrics contain the expected data
-    metrics_text = metrics_response.text
-    assert "test_stream_chunks_total" in metrics_text
-    assert "test_stream_bytes_total" in metrics_text
+    assert REGISTRY.get_sample_value("test_stream_chunks_total", labels) == chunks_before + len(_CHUNKS)
+    assert REGISTRY.get_sample_value("test_stream_bytes_total", labels) == bytes_before + len(body)
 
 
-def test_decorated_streaming_response(client):
+@pytest.mark.anyio
+async def test_decorated_streaming_response(client):
     """Test that decorated streaming responses work."""
-    response = client.get("/stream2")
-    assert response.status_code == 200
-    assert response.headers["content-type"] == "text/event-stream"
+    async with client.stream("GET", "/stream2") as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        body = b"".join([chunk async for chunk in response.aiter_bytes()])
+    assert body == b"".join(_CHUNKS)
     
     # Get the metrics
-    metrics_response = client.get("/metrics")
+    metrics_response = await client.get("/metrics")
     assert metrics_response.status_code == 200
     
     # Check that the streaming metrics contain the expected data
     metrics_text = metrics_response.text
     assert "test_stream_chunks_total" in metrics_text
     assert "test_stream_bytes_total" in metrics_text
+
+
+def test_stream_counter_api():
+    """Test that the stream chunk counter supports the prometheus_client Counter API."""
+    metrics = StreamingMetrics(prefix="counter_api_test")
+    counter = metrics.stream_chunks_total
+
+    counter.labels(endpoint="/a").inc(2)
+    assert counter.labels("/a") is counter.labels(endpoint="/a")
+    assert REGISTRY.get_sample_value("counter_api_test_stream_chunks_total", {"endpoint": "/a"}) == 2
+
+    with pytest.raises(ValueError):
+        counter.labels("/a").inc(-1)
+    with pytest.raises(ValueError):
+        counter.labels(path="/a")
+
+    counter.remove("/a")
+    assert REGISTRY.get_sample_value("counter_api_test_stream_chunks_total", {"endpoint": "/a"}) is None
+    counter.labels("/b").inc()
+    counter.clear()
+    assert REGISTRY.get_sample_value("counter_api_test_stream_chunks_total", {"endpoint": "/b"}) is None
+
+
+def test_strict_bytes_rejects_str_chunks(wrapper_metrics):
+    """Test that strict_bytes raises TypeError on a str chunk and counts the stream error."""
+    labels = {"endpoint": "/strict", "error_type": "TypeError"}
+    before = REGISTRY.get_sample_value("wrapper_test_stream_errors_total", labels) or 0
+
+    async def consume():
+        async for _ in track_streaming_generator(_generate(["data"]), "/strict", strict_bytes=True):
+            pass
+
+    with pytest.raises(TypeError):
+        asyncio.run(consume())
+
+    assert REGISTRY.get_sample_value("wrapper_test_stream_errors_total", labels) == before + 1
+    assert REGISTRY.get_sample_value("wrapper_test_active_streams", {"endpoint": "/strict"}) == 0
+
+
+def test_strict_bytes_rejects_later_str_chunks(wrapper_metrics):
+    """Test that strict_bytes checks every chunk, not only the first one."""
+    labels = {"endpoint": "/strict-later", "error_type": "TypeError"}
+    before = REGISTRY.get_sample_value("wrapper_test_stream_errors_total", labels) or 0
+
+    async def consume():
+        async for _ in track_streaming_generator(_generate([b"data", "more"]), "/strict-later", strict_bytes=True):
+            pass
+
+    with pytest.raises(TypeError):
+        asyncio.run(consume())
+
+    assert REGISTRY.get_sample_value("wrapper_test_stream_errors_total", labels) == before + 1
+
+
+def test_strict_bytes_passed_through_decorator(wrapper_metrics):
+    """Test that streaming_response_decorator passes strict_bytes to the tracked stream."""
+    labels = {"endpoint": "/strict-decorated", "error_type": "TypeError"}
+    before = REGISTRY.get_sample_value("wrapper_test_stream_errors_total", labels) or 0
+
+    @streaming_response_decorator(endpoint="/strict-decorated", strict_bytes=True)
+    async def endpoint():
+        yield "data"
+
+    async def consume():
+        response = await endpoint()
+        async for _ in response.body_iterator:
+            pass
+
+    with pytest.raises(TypeError):
+        asyncio.run(consume())
+
+    assert REGISTRY.get_sample_value("wrapper_test_stream_errors_total", labels) == before + 1
+
+
+def test_disabled_stream_metrics_return_generator(monkeypatch, wrapper_metrics):
+    """Test that disabled streaming metrics hand back the original generator."""
+    monkeypatch.setattr(streaming_wrapper, "STREAM_METRICS_DISABLED", True)
+    generator = _generate(_CHUNKS)
+
+    assert track_streaming_generator(generator, "/disabled") is generator
+    assert wrap_streaming_response(generator, endpoint="/disabled") is generator
+    assert REGISTRY.get_sample_value("wrapper_test_active_streams", {"endpoint": "/disabled"}) is None
+
+
+def test_stream_counts_flushed_in_batches(monkeypatch, wrapper_metrics):
+    """Test that chunk and byte counts are flushed every STREAM_FLUSH_CHUNKS chunks and at the end."""
+    monkeypatch.setattr(streaming_wrapper, "STREAM_FLUSH_INTERVAL_NS", float("inf"))
+    labels = {"endpoint": "/batched"}
+    flush_chunks = streaming_wrapper.STREAM_FLUSH_CHUNKS
+    total_chunks = flush_chunks * 2 + 5
+
+    def counts():
+        return (
+            REGISTRY.get_sample_value("wrapper_test_stream_chunks_total", labels),
+            REGISTRY.get_sample_value("wrapper_test_stream_bytes_total", labels)
+        )
+
+    async def consume():
+        seen = []
+        async for _ in track_streaming_generator(_generate([b"ab"] * total_chunks), "/batched"):
+            seen.append(counts())
+        return seen
+
+    seen = asyncio.run(consume())
+
+    # Counts are buffered until STREAM_FLUSH_CHUNKS chunks have been sent
+    assert seen[flush_chunks - 2] == (0, 0)
+    assert seen[flush_chunks - 1] == (flush_chunks, flush_chunks * 2)
+    assert counts() == (total_chunks, total_chunks * 2)
+
+
+def test_endpoint_label_cap():
+    """Test that endpoints beyond the cap collapse into the overflow label."""
+    metrics = StreamingMetrics(prefix="cap_test", max_endpoints=2)
+    metrics.track_stream_started("/a")
+    metrics.track_stream_started("/b")
+    metrics.track_stream_started("/c")
+
+    assert set(metrics._child_cache) == {"/a", "/b", "__overflow__"}
+
+
+def test_stream_durations_batched():
+    """Test that stream durations are batched in an event loop and observed on collection."""
+    metrics = StreamingMetrics(prefix="batch_test")
+    labels = {"endpoint": "/a"}
+    metrics.track_stream_started("/a")
+
+    def observed():
+        # Collecting the histogram alone does not flush batched durations
+        for family in metrics.stream_duration_seconds.collect():
+            for sample in family.samples:
+                if sample.name == "batch_test_stream_duration_seconds_count" and sample.labels == labels:
+                    return sample.value
+        return 0
+
+    async def finish():
+        metrics.track_stream_finished("/a", 1.0)
+        return observed()
+
+    assert asyncio.run(finish()) == 0
+
+    # Collecting the registry, as a scrape does, flushes the batch
+    assert REGISTRY.get_sample_value("batch_test_stream_duration_seconds_count", labels) == 1